@@ -1,9 +1,15 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import click
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 INFO = '''
 The selected mgf file has {n} lines, of which {m} were corrected. 
 '''
+CHUNK_SIZE = 8 * 1024 * 1024  # bytes of lines read (and written) at once
+RECORD_START = b'Name:'
 
 # def fix_mgf_title(line:str):
 # 	return "TITLE=" + line.split('=')[-1]
@@ -26,31 +32,106 @@ def print_help():
     click.echo(ctx.get_help())
     ctx.exit()
 
+def correct_line(line: bytes) -> bytes:
+    """
+    blank to tab correction of a single peak data line, all other lines are returned unchanged
+    """
+    if line[:1].isdigit():
+        return line.replace(b' ',b'\t').strip()+b'\t""\n'
+    return line
+
+def correct_stream(infile, outfile, end=None):
+    """
+    correct_stream reads lines in chunks of about CHUNK_SIZE bytes from infile (binary) and writes 
+    the corrected lines to outfile (binary), stopping at byte offset end if given. 
+    Only the current chunk is held in memory.
+    Returns the number of lines read and the number of lines corrected.
+    """
+    n, m = 0, 0
+    while end is None or infile.tell() < end:
+        hint = CHUNK_SIZE if end is None else max(1, min(CHUNK_SIZE, end - infile.tell()))
+        lines = infile.readlines(hint)
+        if not lines:
+            break
+        if end is not None and infile.tell() > end:
+            # readlines may overshoot the hint by a line, these belong to the next range
+            excess = infile.tell() - end
+            while excess > 0:
+                excess -= len(lines.pop())
+        corrected = [correct_line(line) for line in lines]
+        m += sum(i!=j for i, j in zip(lines, corrected))
+        n += len(lines)
+        outfile.writelines(corrected)
+    return n, m
+
+def find_record_boundaries(input_filepath, parts):
+    """
+    find_record_boundaries splits the file into about equally sized byte ranges, 
+    each starting at a record (i.e. a line starting with 'Name:') or the start of the file
+    """
+    size = os.path.getsize(input_filepath)
+    boundaries = [0]
+    with open(input_filepath,'rb') as infile:
+        for i in range(1, parts):
+            infile.seek(max(size * i // parts, boundaries[-1]))
+            infile.readline()  # skip to the start of the next full line
+            while True:
+                pos = infile.tell()
+                line = infile.readline()
+                if not line or line.startswith(RECORD_START):
+                    break
+            if pos > boundaries[-1]:
+                boundaries.append(pos)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def correct_range(input_filepath, part_filepath, start, end):
+    """
+    correct the lines in byte range [start, end) of the input file into a separate part file
+    """
+    with open(input_filepath,'rb') as infile, open(part_filepath,'wb') as outfile:
+        infile.seek(start)
+        return correct_stream(infile, outfile, end)
+
+def correct_file_parallel(input_filepath, output_filepath, jobs):
+    """
+    correct the file in `jobs` record-aligned parts concurrently, then concatenate the parts in order
+    """
+    ranges = find_record_boundaries(input_filepath, jobs)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_filepath))) as tmpdir:
+        part_filepaths = [os.path.join(tmpdir, "part{}".format(i)) for i in range(len(ranges))]
+        with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+            counts = list(pool.map(correct_range, [input_filepath]*len(ranges), part_filepaths, *zip(*ranges)))
+        with open(output_filepath,'wb') as outfile:
+            for part_filepath in part_filepaths:
+                with open(part_filepath,'rb') as part:
+                    shutil.copyfileobj(part, outfile, CHUNK_SIZE)
+    return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
 @click.command(short_help='correct_mgf_tabs will correct the peak data tab separation in any spectra of the mgf')
 @click.argument('input_filepath', type=click.Path(exists=True,readable=True) )  # help="The input file path for the mgf to be corrected")
 @click.argument('output_filepath', type=click.Path(writable=True) )  # help="The output destination path for the corrected mgf file")
-def correct_mgf_tabs(input_filepath, output_filepath):
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1, show_default=True,
+    help="Number of processes correcting record-aligned parts of the input concurrently.")
+def correct_mgf_tabs(input_filepath, output_filepath, jobs):
     """
     correct_mgf_tabs will correct only the peak data lines' tab separation if 
     any elments are separated by a blank rather than a tab for all lines.
+    The input is streamed in chunks, so memory use does not depend on the library size.
     """
     if not any([input_filepath,output_filepath]):
         print_help()
     try:
-        with open(input_filepath,'r') as infile:
-            lines = infile.readlines()
+        if jobs > 1:
+            n, m = correct_file_parallel(input_filepath, output_filepath, jobs)
+        else:
+            with open(input_filepath,'rb') as infile, open(output_filepath,'wb') as outfile:
+                n, m = correct_stream(infile, outfile)
     except Exception as e:
         click.echo(e)
         print_help()
 
-    n=len(lines)
-    corrected = [line.replace(' ','\t').strip()+'\t""' if line[0].isdigit() else line for line in lines]
-    diff = sum([i!=j for i, j in zip(lines, corrected)])
-    
-    with open(output_filepath,'w') as file:
-        file.writelines(corrected)
-    
-    print(INFO.format(m=diff, n=n))
+    print(INFO.format(m=m, n=n))
 
 if __name__ == '__main__':
-    correct_mgf_tabs()
\ No newline at end of file
+    correct_mgf_tabs()
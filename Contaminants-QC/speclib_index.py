@@ -0,0 +1,182 @@
+import os
+import re
+import hashlib
+import numpy as np
+import click
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+INFO = '''
+The selected library has {n} spectra, indexed into {i}.
+'''
+
+# Index file layout (little endian):
+#   header   MAGIC (8 bytes), number of spectra (uint64)
+#   records  RECORD_DTYPE array sorted by precursor m/z
+#   keys     KEY_DTYPE array sorted by peptide/charge key, pointing into records
+MAGIC = b'SPLBIDX1'
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('count', '<u8')])
+RECORD_DTYPE = np.dtype([('mz', '<f8'), ('offset', '<u8'), ('length', '<u4'), ('charge', '<i4'), ('key', '<u8')])
+KEY_DTYPE = np.dtype([('key', '<u8'), ('row', '<u8')])
+INDEX_SUFFIX = '.pmzidx'
+
+PARENT_RE = re.compile(rb'Parent=([0-9.]+)')
+CHARGE_RE = re.compile(rb'\d+')
+
+
+def print_help():
+    """
+    Print the help of the tool
+    :return:
+    """
+    ctx = click.get_current_context()
+    click.echo(ctx.get_help())
+    ctx.exit()
+
+def peptide_key(peptide: str, charge: int) -> int:
+    """
+    64bit key of the peptide/charge combination as used in the library 'Name:' lines (e.g. 'PEPTIDER/2')
+    """
+    return int.from_bytes(hashlib.blake2b("{}/{}".format(peptide, charge).encode(), digest_size=8).digest(), 'little')
+
+def parse_name(name: bytes):
+    """
+    split a 'Name:' value into peptide and charge, ignoring any suffix to the charge (e.g. NIST's 'PEPTIDE/2_0')
+    """
+    peptide, _, charge = name.strip().rpartition(b'/')
+    digits = CHARGE_RE.match(charge)
+    if digits is None:
+        raise ValueError("No charge in library entry name {}.".format(name.decode()))
+    return peptide.decode(), int(digits.group())
+
+def scan_library(library_path: str):
+    """
+    scan_library reads a text spectral library (NIST msp or SpectraST sptxt) once,
+    yielding (precursor m/z, byte offset, byte length, charge, key) for each record
+    """
+    def record(start, end, name, mz):
+        peptide, charge = parse_name(name)
+        if np.isnan(mz):
+            raise ValueError("No precursor m/z for library entry {}.".format(name.decode()))
+        return mz, start, end - start, charge, peptide_key(peptide, charge)
+
+    start, name, mz = None, None, np.nan
+    with open(library_path, 'rb') as lib:
+        offset = 0
+        for line in lib:
+            if line.startswith(b'Name:'):
+                if name is not None:
+                    yield record(start, offset, name, mz)
+                start, name, mz = offset, line[5:], np.nan
+            elif name is not None:
+                # sptxt provides PrecursorMZ, msp only the Parent in the comment line
+                if line.startswith(b'PrecursorMZ:'):
+                    mz = float(line[12:])
+                elif line.startswith(b'Comment:') and np.isnan(mz):
+                    parent = PARENT_RE.search(line)
+                    if parent:
+                        mz = float(parent.group(1))
+            offset += len(line)
+        if name is not None:
+            yield record(start, offset, name, mz)
+
+def build_index(library_path: str, index_path: str = None) -> str:
+    """
+    build_index creates the binary offset index for the given library,
+    by default next to it with the '.pmzidx' suffix, and returns its path
+    """
+    index_path = index_path or library_path + INDEX_SUFFIX
+    records = np.fromiter(scan_library(library_path), dtype=RECORD_DTYPE)
+    records = records[np.argsort(records['mz'], kind='stable')]
+    keys = np.empty(records.size, dtype=KEY_DTYPE)
+    keys['key'] = records['key']
+    keys['row'] = np.arange(records.size)
+    keys = keys[np.argsort(keys['key'], kind='stable')]
+
+    header = np.array([(MAGIC, records.size)], dtype=HEADER_DTYPE)
+    with open(index_path, 'wb') as idx:
+        idx.write(header.tobytes())
+        idx.write(records.tobytes())
+        idx.write(keys.tobytes())
+    return index_path
+
+
+class SpectralLibraryIndex:
+    """
+    SpectralLibraryIndex memory-maps a '.pmzidx' file to find library records
+    by precursor m/z window or peptide/charge and reads only those records from the library
+    """
+    def __init__(self, library_path: str, index_path: str = None):
+        self.library_path = library_path
+        self.index_path = index_path or library_path + INDEX_SUFFIX
+        header = np.fromfile(self.index_path, dtype=HEADER_DTYPE, count=1)
+        if header.size != 1 or header['magic'][0] != MAGIC:
+            raise ValueError("Not a spectral library index file: {}".format(self.index_path))
+        n = int(header['count'][0])
+        self.records = np.memmap(self.index_path, dtype=RECORD_DTYPE, mode='r',
+                                 offset=HEADER_DTYPE.itemsize, shape=(n,))
+        self.keys = np.memmap(self.index_path, dtype=KEY_DTYPE, mode='r',
+                              offset=HEADER_DTYPE.itemsize + RECORD_DTYPE.itemsize * n, shape=(n,))
+
+    def __len__(self):
+        return self.records.shape[0]
+
+    def query_mz(self, lower: float, upper: float, charge: int = None) -> np.ndarray:
+        """
+        records with precursor m/z in [lower, upper], optionally only of the given charge
+        """
+        mzs = self.records['mz']
+        hits = self.records[np.searchsorted(mzs, lower, side='left'):np.searchsorted(mzs, upper, side='right')]
+        if charge is not None:
+            hits = hits[hits['charge'] == charge]
+        return hits
+
+    def query_ppm(self, mz: float, ppm: float, charge: int = None) -> np.ndarray:
+        """
+        records within a ppm tolerance window around the given precursor m/z
+        """
+        delta = mz * ppm * 1e-6
+        return self.query_mz(mz - delta, mz + delta, charge)
+
+    def lookup(self, peptide: str, charge: int) -> np.ndarray:
+        """
+        records of the given peptide (as written in the library 'Name:' lines) and charge
+        """
+        key = peptide_key(peptide, charge)
+        keys = self.keys['key']
+        rows = self.keys['row'][np.searchsorted(keys, key, side='left'):np.searchsorted(keys, key, side='right')]
+        hits = self.records[np.sort(rows)]
+        # guard against (unlikely) hash collisions
+        return hits[[parse_name(spectrum.split(b'\n', 1)[0][5:]) == (peptide, charge)
+                     for spectrum in self.fetch(hits)]]
+
+    def fetch(self, records: np.ndarray):
+        """
+        read the raw text of the given records from the library, in the order given
+        """
+        with open(self.library_path, 'rb') as lib:
+            for offset, length in zip(records['offset'], records['length']):
+                lib.seek(int(offset))
+                yield lib.read(int(length))
+
+
+@click.command(short_help='speclib_index will build a precursor m/z and peptide/charge offset index for a msp/sptxt spectral library')
+@click.argument('library_filepath', type=click.Path(exists=True,readable=True) )  # help="The msp or sptxt library to index")
+@click.option('-o', '--output', 'index_filepath', type=click.Path(writable=True),
+    required=False, help="The index output path (default: library path with '.pmzidx' appended).")
+def index_spectral_library(library_filepath, index_filepath):
+    """
+    index_spectral_library creates a compact, memory-mappable index of all records'
+    byte offsets in the library, sorted by precursor m/z
+    """
+    if not library_filepath:
+        print_help()
+    try:
+        index_filepath = build_index(library_filepath, index_filepath)
+    except Exception as e:
+        click.echo(e)
+        print_help()
+
+    print(INFO.format(n=len(SpectralLibraryIndex(library_filepath, index_filepath)), i=index_filepath))
+
+if __name__ == '__main__':
+    index_spectral_library()
@@ -141,7 +141,8 @@ def mzqc_to_single_run_report(mzqc_obj, pre_irt_plot=None):
     mz_range = next(iter(list(filter(lambda x: x.accession == "MS:4000069", mzqc_obj.runQualities[0].qualityMetrics)))).value
     rt_range = next(iter(list(filter(lambda x: x.accession == "MS:4000070", mzqc_obj.runQualities[0].qualityMetrics)))).value
     tic = next(iter(list(filter(lambda x: x.accession == "MS:4000104", mzqc_obj.runQualities[0].qualityMetrics)))).value
-    conta = next(iter(list(filter(lambda x: x.accession == "MS:4000xx3", mzqc_obj.runQualities[0].qualityMetrics)))).value
+    # contaminants come from the speclib-usecase, the others are also calculated by pymzqc-usecase
+    conta = next(iter(list(filter(lambda x: x.accession == "MS:4000xx3", mzqc_obj.runQualities[0].qualityMetrics))), None)
     
     if not pre_irt_plot:
         irt_plot = plot_to_b64(plot_blank())
@@ -153,7 +154,10 @@ def mzqc_to_single_run_report(mzqc_obj, pre_irt_plot=None):
     tic_plot = plot_to_b64(f)
     mz_plot = plot_to_b64(plot_range_mz(mz_range))
     rt_plot = plot_to_b64(plot_range_rt(rt_range))
-    conta_tab = pd.DataFrame(conta).rename(columns={"MS:1003169": "Contaminant", "MS:1002733": "Spectrum Count"}).to_html(border=1)
+    if conta:
+        conta_tab = pd.DataFrame(conta.value).rename(columns={"MS:1003169": "Contaminant", "MS:1002733": "Spectrum Count"}).to_html(border=1)
+    else:
+        conta_tab = "<p>No contaminant metric in the given mzQC.</p>"
 
     return report_tmplt.format(name=name, mz_plot=mz_plot, rt_plot=rt_plot, irt_plot=irt_plot, tic_plot=tic_plot, conta_tab=conta_tab)
 
@@ -0,0 +1,273 @@
+#!/usr/local/bin/python
+"""
+Batch validation of mzQC files or in-memory MzQcFile objects.
+The mzQC JSON schema is compiled and the controlled vocabularies are reduced to plain term lookups once
+(and cached as JSON, see TERMS_CACHE_DIR), then all documents are validated in worker processes and the results aggregated into one report.
+"""
+import os
+import json
+import hashlib
+import logging
+import urllib.request
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Set, Union
+import jsonschema
+from mzqc import MZQCFile as qc
+import click
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+SCHEMA_URL = "https://raw.githubusercontent.com/HUPO-PSI/mzQC/v1.0.0/schema/mzqc_schema.json"
+PSI_MS_URL = "https://github.com/HUPO-PSI/psi-ms-CV/releases/download/v4.1.130/psi-ms.obo"
+QC_METRIC = "MS:4000002"
+QC_TABLE = "MS:4000005"
+TERMS_CACHE_DIR = os.environ.get('MZQC_TERMS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'mzqc_validation'))
+
+_worker_validator = None
+
+
+def print_help():
+    """
+    Print the help of the tool
+    :return:
+    """
+    ctx = click.get_current_context()
+    click.echo(ctx.get_help())
+    ctx.exit()
+
+def load_schema(source: str = SCHEMA_URL) -> Dict:
+    """
+    load the mzQC JSON schema from a local path or URL
+    """
+    if os.path.exists(source):
+        with open(source, 'r') as schema_in:
+            return json.load(schema_in)
+    with urllib.request.urlopen(source, timeout=10) as schema_in:
+        return json.loads(schema_in.read().decode())
+
+def reduce_vocabulary(voc) -> Dict:
+    """
+    reduce a (pronto) ontology to picklable lookups: term names by accession, the accessions of all QC metric terms, 
+    the required columns of table metrics, and the accession prefixes
+    """
+    names = {term.id: term.name for term in voc.terms()}
+    metrics = sorted(t.id for t in voc[QC_METRIC].subclasses(with_self=False)) if QC_METRIC in voc else list()
+    columns = {table.id: sorted({col.id for rel, cols in table.relationships.items() if rel.id == 'has_column' for col in cols})
+               for table in voc[QC_TABLE].subclasses(with_self=False)} if QC_TABLE in voc else dict()
+    return {'names': names, 'metrics': metrics, 'columns': columns, 'prefixes': sorted({a.partition(':')[0] for a in names})}
+
+def cached_vocabulary(source: str) -> Dict:
+    """
+    the reduced lookups of an ontology (path or URL), cached as JSON in TERMS_CACHE_DIR, 
+    keyed by the source (and modification time of local files), so the obo is only parsed on first use
+    """
+    key = source if not os.path.exists(source) else "{}:{}".format(os.path.abspath(source), os.stat(source).st_mtime_ns)
+    cache = os.path.join(TERMS_CACHE_DIR, hashlib.sha256(key.encode()).hexdigest()[:16] + '.json')
+    try:
+        with open(cache, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    import pronto
+    terms = reduce_vocabulary(pronto.Ontology(source, import_depth=0))
+    try:
+        os.makedirs(TERMS_CACHE_DIR, exist_ok=True)
+        with open(cache, 'w') as f:
+            json.dump(terms, f)
+    except OSError as e:
+        logging.debug("Could not cache the terms of {}: {}".format(source, e))
+    return terms
+
+def load_vocabulary_terms(sources: List[Union[str, Any]]) -> Dict:
+    """
+    load_vocabulary_terms combines the reduced lookups of the given ontologies, 
+    each either a path or URL (see cached_vocabulary) or an already loaded pronto.Ontology
+    """
+    names: Dict[str,str] = dict()
+    metrics: Set[str] = set()
+    columns: Dict[str,List[str]] = dict()
+    prefixes: Set[str] = set()
+    for source in sources:
+        voc = cached_vocabulary(source) if isinstance(source, str) else reduce_vocabulary(source)
+        names.update(voc['names'])
+        metrics.update(voc['metrics'])
+        columns.update(voc['columns'])
+        prefixes.update(voc['prefixes'])
+    return {'names': names, 'metrics': metrics, 'columns': columns, 'prefixes': prefixes}
+
+
+class MzqcValidator:
+    """
+    MzqcValidator holds the compiled schema validator and vocabulary term lookups,
+    so validating a document costs only the schema traversal and dict lookups
+    """
+    def __init__(self, schema: Dict, terms: Dict):
+        self.schema = schema
+        self.terms = terms
+        validator_class = jsonschema.validators.validator_for(schema)
+        self.validator = validator_class(schema, format_checker=jsonschema.FormatChecker())
+
+    def __reduce__(self):
+        # the compiled validator is rebuilt on unpickling (i.e. once per worker)
+        return (MzqcValidator, (self.schema, self.terms))
+
+    def check_schema(self, doc: Dict) -> List[str]:
+        return ["{} @ {}".format(e.message.partition('\n')[0], ''.join('[{}]'.format(k) for k in e.path))
+                for e in self.validator.iter_errors(doc)]
+
+    def check_cv(self, doc: Dict) -> List[str]:
+        """
+        check all cv parameter like elements: known accession, matching name,
+        quality metrics being QC metric terms, and tables having their required columns
+        """
+        issues = list()
+        mzqc = doc.get('mzQC', doc)
+        names, prefixes = self.terms['names'], self.terms['prefixes']
+
+        def visit(obj, path):
+            if isinstance(obj, dict):
+                acc = obj.get('accession')
+                if isinstance(acc, str) and acc.partition(':')[0] in prefixes:
+                    if acc not in names:
+                        issues.append("Unknown accession {} @ {}".format(acc, path))
+                    elif 'name' in obj and obj['name'] != names[acc]:
+                        issues.append("Name '{}' does not match accession {} ('{}') @ {}".format(obj['name'], acc, names[acc], path))
+                for k, v in obj.items():
+                    visit(v, "{}[{}]".format(path, k))
+            elif isinstance(obj, list):
+                for i, v in enumerate(obj):
+                    visit(v, "{}[{}]".format(path, i))
+        visit(mzqc, '')
+
+        for quality_type in ('runQualities', 'setQualities'):
+            for qi, quality in enumerate(mzqc.get(quality_type) or []):
+                for mi, metric in enumerate(quality.get('qualityMetrics') or []):
+                    acc = metric.get('accession')
+                    path = "[{}][{}][qualityMetrics][{}]".format(quality_type, qi, mi)
+                    if acc in names and acc not in self.terms['metrics']:
+                        issues.append("Accession {} is not a QC metric @ {}".format(acc, path))
+                    required = self.terms['columns'].get(acc)
+                    if required:
+                        value = metric.get('value')
+                        if not isinstance(value, dict):
+                            issues.append("Table metric {} has no table value @ {}".format(acc, path))
+                            continue
+                        missing = [c for c in required if c not in value]
+                        if missing:
+                            issues.append("Table metric {} misses required columns {} @ {}".format(acc, ', '.join(missing), path))
+                        if len({len(c) for c in value.values() if isinstance(c, list)}) > 1:
+                            issues.append("Table metric {} has columns of unequal length @ {}".format(acc, path))
+        return issues
+
+    def validate_json(self, mzqc_str: str) -> Dict[str,List[str]]:
+        try:
+            doc = json.loads(mzqc_str)
+        except ValueError as e:
+            return {'schema validation': ["Given mzqc seems not to be a string representation of a json type: {}".format(e)],
+                    'cv terms': []}
+        return {'schema validation': self.check_schema(doc), 'cv terms': self.check_cv(doc)}
+
+    def validate_file(self, path: str) -> Dict[str,List[str]]:
+        with open(path, 'r') as f:
+            return self.validate_json(f.read())
+
+
+@dataclass
+class ValidationReport:
+    results: Dict[str, Dict[str, List[str]]] = field(default_factory=dict)
+
+    @property
+    def valid(self) -> bool:
+        return not any(issues for result in self.results.values() for issues in result.values())
+
+    def invalid(self) -> List[str]:
+        return [name for name, result in self.results.items() if any(result.values())]
+
+    def summary(self) -> str:
+        invalid = self.invalid()
+        lines = ["{} of {} mzQC valid.".format(len(self.results) - len(invalid), len(self.results))]
+        for name in invalid:
+            for category, issues in self.results[name].items():
+                lines.extend("{}: {}: {}".format(name, category, i) for i in issues)
+        return '\n'.join(lines)
+
+    def write(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({'valid': self.valid, 'results': self.results}, f, indent=1)
+
+
+def _init_worker(validator: MzqcValidator):
+    global _worker_validator
+    _worker_validator = validator
+
+def _validate_file(path: str) -> Dict[str,List[str]]:
+    return _worker_validator.validate_file(path)
+
+def _validate_json(mzqc_str: str) -> Dict[str,List[str]]:
+    return _worker_validator.validate_json(mzqc_str)
+
+def validate(validator: MzqcValidator, documents: List[Union[str, qc.MzQcFile]], jobs: int = 1) -> ValidationReport:
+    """
+    validate mzQC file paths and/or in-memory MzQcFile objects, in `jobs` worker processes
+    in-memory objects are reported as '<object N>'
+    """
+    names, payloads, is_path = list(), list(), list()
+    for i, d in enumerate(documents):
+        if isinstance(d, qc.MzQcFile):
+            names.append("<object {}>".format(i))
+            payloads.append(qc.JsonSerialisable.ToJson(d))
+            is_path.append(False)
+        else:
+            names.append(d)
+            payloads.append(d)
+            is_path.append(True)
+
+    if jobs > 1 and len(payloads) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(payloads)), initializer=_init_worker, initargs=(validator,)) as pool:
+            futures = [pool.submit(_validate_file if p else _validate_json, pl) for pl, p in zip(payloads, is_path)]
+            results = [f.result() for f in futures]
+    else:
+        results = [validator.validate_file(pl) if p else validator.validate_json(pl) for pl, p in zip(payloads, is_path)]
+    return ValidationReport(dict(zip(names, results)))
+
+def post_write_validation(mzqc_output: str, schema: str = SCHEMA_URL, vocabularies: List[Union[str, Any]] = (PSI_MS_URL,)) -> ValidationReport:
+    """
+    convenience for the calculator and merge CLIs: validate the just written file, log any issues,
+    vocabularies already loaded (pronto.Ontology) are reduced directly, others come from the terms cache
+    """
+    validator = MzqcValidator(load_schema(schema), load_vocabulary_terms(list(vocabularies)))
+    report = validate(validator, [mzqc_output])
+    if report.valid:
+        logging.info("Output {} passed validation.".format(mzqc_output))
+    else:
+        logging.warning(report.summary())
+    return report
+
+
+@click.command(short_help='Validate many mzQC files against the mzQC schema and controlled vocabulary in parallel.')
+@click.argument('mzqc_input', nargs=-1, type=click.Path(exists=True,readable=True, dir_okay=False) )  # help="The mzqc files to validate"
+@click.option('--schema', show_default=True, default=SCHEMA_URL, help="Path or URL of the mzQC JSON schema.")
+@click.option('--cv', 'vocabularies', multiple=True, show_default=True, default=[PSI_MS_URL], help="Path or URL of a controlled vocabulary (repeatable).")
+@click.option('-j', '--jobs', type=click.IntRange(min=1), show_default=True, default=os.cpu_count() or 1, help="Number of worker processes.")
+@click.option('-r', '--report', type=click.Path(writable=True, dir_okay=False), required=False, help="Write the aggregated report as JSON.")
+@click.option('--log', type=click.Choice(['debug', 'info', 'warn'], case_sensitive=False),
+    default='warn', show_default=True,
+    required=False, help="Log detail level. (verbosity: debug>info>warn)")
+def validate_mzqc_files(mzqc_input, schema, vocabularies, jobs, report, log):
+    lev = {'debug': logging.DEBUG,
+        'info': logging.INFO,
+        'warn': logging.WARN }
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=lev[log])
+
+    if not mzqc_input:
+        print_help()
+    validator = MzqcValidator(load_schema(schema), load_vocabulary_terms(list(vocabularies)))
+    res = validate(validator, list(mzqc_input), jobs)
+    if report:
+        res.write(report)
+    click.echo(res.summary())
+    if not res.valid:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    validate_mzqc_files()
@@ -0,0 +1,234 @@
+#!/usr/local/bin/python
+"""
+Columnar readers for the peptide-spectrum matches (PSMs) of different search engines.
+Each backend parses its result files in chunks, projected to the needed columns with explicit dtypes,
+into one PSM table of common schema (PSM_COLUMNS plus the backend's score column).
+Chunking bounds the parser's memory, the PSM table itself is held in memory whole (as crema needs it).
+From that, assign_qvalues derives the identifications (id_df) of pymzqc-usecase with crema q-values.
+With engine `pyarrow`, delimited files are read with pyarrow's multithreaded streaming CSV reader.
+"""
+import re
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, Iterator, List
+import numpy as np
+import pandas as pd
+from lxml import etree
+import crema
+
+PROTON = 1.007276466621
+CHUNKSIZE = 1 << 18  # rows (or spectrum queries for pepXML) per chunk
+BLOCKSIZE = 1 << 24  # bytes per chunk with the pyarrow engine
+ENGINES = ['c', 'pyarrow']
+# the common PSM table, the score column is added by the backend
+PSM_COLUMNS = {'scan_id': 'i8', 'charge': 'i2', 'sequence': 'str', 'protein id': 'str', 'target/decoy': 'bool',
+               'peptide mass': 'f8', 'experimentalMassToCharge': 'f8', 'calculatedMassToCharge': 'f8'}
+
+
+def header_columns(path: str, skiprows: int = 0) -> List[str]:
+    with open(path, 'r') as f:
+        for _ in range(skiprows):
+            f.readline()
+        return f.readline().rstrip('\r\n').split('\t')
+
+def read_delimited(path: str, columns: Dict[str, str], chunksize: int = CHUNKSIZE, engine: str = 'c', skiprows: int = 0) -> Iterator[pd.DataFrame]:
+    """
+    iterate over chunks of a tab-delimited file, parsing only the given columns with the given dtypes ('i8', 'f8', 'str', ...)
+    """
+    if engine == 'pyarrow':
+        import pyarrow as pa
+        from pyarrow import csv
+        types = {c: pa.string() if d == 'str' else pa.from_numpy_dtype(np.dtype(d)) for c, d in columns.items()}
+        reader = csv.open_csv(path, read_options=csv.ReadOptions(skip_rows=skiprows, use_threads=True, block_size=BLOCKSIZE),
+                              parse_options=csv.ParseOptions(delimiter='\t'),
+                              convert_options=csv.ConvertOptions(include_columns=list(columns), column_types=types))
+        for batch in reader:
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, sep='\t', skiprows=skiprows, usecols=list(columns), dtype=columns, chunksize=chunksize)
+
+def is_target(proteins: pd.Series, decoy_prefix: str) -> pd.Series:
+    """
+    a PSM is a target if any of its (comma separated) proteins is not prefixed as decoy
+    """
+    return proteins.str.contains(r'(?:^|,)(?!{})'.format(re.escape(decoy_prefix)), regex=True)
+
+def reverse_inner(sequence: str) -> str:
+    """
+    reverse all but the terminal residues (modifications stay with their residue), as for crema's implicit Comet pairing
+    """
+    residues = re.split(r"(?<=.)(?=[A-Z])", sequence)
+    return ''.join([residues[0], *reversed(residues[1:-1]), residues[-1]]) if len(residues) > 2 else sequence
+
+
+class PsmReader(ABC):
+    """
+    PsmReader is the base of the search engine backends:
+    `chunks` yields the PSM table in chunks, `read` returns it whole, 
+    `pairing` the target to decoy peptide pairing for crema's peptide-level competition
+    """
+    name = ''
+    score_column = ''
+    score_desc = True
+    file_format = ("MS:1000914", "tab delimited text format")
+    software = ("", "", "", "")  # accession, name, version, uri
+
+    def __init__(self, files: List[str], decoy_prefix: str = 'DECOY_', chunksize: int = CHUNKSIZE, engine: str = 'c'):
+        self.files = list(files)
+        self.decoy_prefix = decoy_prefix
+        self.chunksize = chunksize
+        self.engine = engine
+
+    @abstractmethod
+    def chunks(self) -> Iterator[pd.DataFrame]:
+        ...
+
+    def read(self) -> pd.DataFrame:
+        """
+        concatenate all chunks into one frame, memory is bounded only by the column projection (not by the chunk size)
+        """
+        chunks = list(self.chunks())
+        if not chunks:
+            return pd.DataFrame({c: pd.Series(dtype=object if d == 'str' else d)
+                                 for c, d in {**PSM_COLUMNS, self.score_column: 'f8'}.items()})
+        return pd.concat(chunks, ignore_index=True)
+
+    def pairing(self, psms: pd.DataFrame) -> Dict[str, str]:
+        return dict()
+
+    def _normalise(self, chunk: pd.DataFrame, exp_neutral: bool) -> pd.DataFrame:
+        """
+        derive the m/z columns from the (renamed) chunk columns, experimental from neutral mass if exp_neutral
+        """
+        charge = chunk['charge'].astype('i2')
+        chunk['calculatedMassToCharge'] = (chunk['peptide mass'] + charge * PROTON) / charge
+        if exp_neutral:
+            chunk['experimentalMassToCharge'] = (chunk['experimentalMassToCharge'] + charge * PROTON) / charge
+        if 'target/decoy' not in chunk:
+            chunk['target/decoy'] = is_target(chunk['protein id'], self.decoy_prefix)
+        return chunk.astype({'charge': 'i2', 'target/decoy': bool})[[*PSM_COLUMNS, self.score_column]]
+
+
+class TideReader(PsmReader):
+    """
+    crux tide-search tab-delimited results (target and decoy files, or concatenated),
+    paired by the tide-index peptide list (tide-index --peptide-list T)
+    """
+    name = 'tide'
+    score_column = 'xcorr score'
+    software = ("MS:1002575", "Tide", "4.2", "https://crux.ms/")
+    columns = {'scan': 'i8', 'charge': 'i2', 'spectrum precursor m/z': 'f8', 'peptide mass': 'f8',
+               'sequence': 'str', 'protein id': 'str', 'xcorr score': 'f8'}
+
+    def __init__(self, files: List[str], pairing_file: str = None, **kwargs):
+        super().__init__(files, **kwargs)
+        self.pairing_file = pairing_file
+
+    def chunks(self) -> Iterator[pd.DataFrame]:
+        for path in self.files:
+            columns = dict(self.columns)
+            if 'target/decoy' in header_columns(path):
+                columns['target/decoy'] = 'str'
+            for chunk in read_delimited(path, columns, self.chunksize, self.engine):
+                chunk = chunk.rename(columns={'scan': 'scan_id', 'spectrum precursor m/z': 'experimentalMassToCharge'})
+                if 'target/decoy' in chunk:
+                    chunk['target/decoy'] = chunk['target/decoy'] == 'target'
+                # protein ids come with the peptide's position, e.g. 'sp|P0A6F5|CH60_ECOLI(123)'
+                chunk['protein id'] = chunk['protein id'].str.replace(r"\([^()]*\)", "", regex=True)
+                yield self._normalise(chunk, exp_neutral=False)
+
+    def pairing(self, psms: pd.DataFrame) -> Dict[str, str]:
+        if not self.pairing_file:
+            logging.warning("No tide-index peptide list given, targets and decoys are not paired.")
+            return dict()
+        pairs = pd.concat(read_delimited(self.pairing_file, {'target': 'str', 'decoy(s)': 'str'}, self.chunksize, self.engine),
+                          ignore_index=True).dropna()
+        return dict(zip(pairs['target'], pairs['decoy(s)']))
+
+
+class CometTxtReader(PsmReader):
+    """
+    Comet tab-delimited results (output_txtfile = 1) of a concatenated target-decoy search (decoy_search = 1)
+    """
+    name = 'comet'
+    score_column = 'xcorr'
+    software = ("MS:1002251", "Comet", "", "https://uwpr.github.io/Comet/")
+    columns = {'scan': 'i8', 'charge': 'i2', 'exp_neutral_mass': 'f8', 'calc_neutral_mass': 'f8',
+               'modified_peptide': 'str', 'protein': 'str', 'xcorr': 'f8'}
+
+    def chunks(self) -> Iterator[pd.DataFrame]:
+        for path in self.files:
+            # the first line of standalone Comet output is the version
+            skip = 1 if header_columns(path)[0].startswith('CometVersion') else 0
+            for chunk in read_delimited(path, self.columns, self.chunksize, self.engine, skiprows=skip):
+                chunk = chunk.rename(columns={'scan': 'scan_id', 'exp_neutral_mass': 'experimentalMassToCharge',
+                                              'calc_neutral_mass': 'peptide mass', 'modified_peptide': 'sequence',
+                                              'protein': 'protein id'})
+                # 'K.PEPTIDER.A' -> 'PEPTIDER'
+                chunk['sequence'] = chunk['sequence'].str.slice(2, -2)
+                yield self._normalise(chunk, exp_neutral=True)
+
+    def pairing(self, psms: pd.DataFrame) -> Dict[str, str]:
+        # Comet decoys are reversed target peptides
+        targets = set(psms.loc[psms['target/decoy'], 'sequence'].unique())
+        pairs = ((reverse_inner(d), d) for d in psms.loc[~psms['target/decoy'], 'sequence'].unique())
+        return {t: d for t, d in pairs if t in targets}
+
+
+class CometPepXmlReader(CometTxtReader):
+    """
+    Comet pepXML results (output_pepxmlfile = 1) of a concatenated target-decoy search, streamed with lxml
+    """
+    name = 'pepxml'
+    file_format = ("MS:1001421", "pepXML format")
+
+    def chunks(self) -> Iterator[pd.DataFrame]:
+        for path in self.files:
+            cols = {c: list() for c in ['scan_id', 'charge', 'experimentalMassToCharge', 'peptide mass', 'sequence', 'protein id', 'xcorr']}
+            for _, query in etree.iterparse(path, tag='{*}spectrum_query'):
+                for hit in query.iterfind('{*}search_result/{*}search_hit'):
+                    mods = hit.find('{*}modification_info')
+                    cols['scan_id'].append(query.get('start_scan'))
+                    cols['charge'].append(query.get('assumed_charge'))
+                    cols['experimentalMassToCharge'].append(query.get('precursor_neutral_mass'))
+                    cols['peptide mass'].append(hit.get('calc_neutral_pep_mass'))
+                    cols['sequence'].append(hit.get('peptide') if mods is None else mods.get('modified_peptide', hit.get('peptide')))
+                    cols['protein id'].append(','.join([hit.get('protein')] + [a.get('protein') for a in hit.iterfind('{*}alternative_protein')]))
+                    cols['xcorr'].append(next((s.get('value') for s in hit.iterfind('{*}search_score') if s.get('name') == 'xcorr'), 'nan'))
+                # keep memory bounded by the chunk size, not the document
+                query.clear()
+                while query.getprevious() is not None:
+                    del query.getparent()[0]
+                if len(cols['scan_id']) >= self.chunksize:
+                    yield self._typed(cols)
+                    cols = {c: list() for c in cols}
+            if cols['scan_id']:
+                yield self._typed(cols)
+
+    def _typed(self, cols: Dict[str, List[str]]) -> pd.DataFrame:
+        chunk = pd.DataFrame({c: np.asarray(v, dtype=object if PSM_COLUMNS.get(c) == 'str' else PSM_COLUMNS.get(c, 'f8'))
+                              for c, v in cols.items()})
+        return self._normalise(chunk, exp_neutral=True)
+
+
+READERS = {r.name: r for r in [TideReader, CometTxtReader, CometPepXmlReader]}
+
+
+def assign_qvalues(reader: PsmReader) -> pd.DataFrame:
+    """
+    assign_qvalues reads the PSMs and assigns peptide-level crema q-values (target-decoy competition), returns
+    the target identifications with their q-value, charge, and experimental and calculated m/z (i.e. the id_df schema)
+    """
+    psms = reader.read()
+    dataset = crema.PsmDataset(psms, target_column='target/decoy', spectrum_columns=['scan_id'],
+                               score_columns=[reader.score_column], peptide_column='sequence',
+                               protein_column='protein id', protein_delim=',',
+                               peptide_pairing=reader.pairing(psms), copy_data=False)
+    # q-values instead of accept flags, so any FDR threshold can be applied later without recalculation
+    results = dataset.assign_confidence(score_column=reader.score_column, desc=reader.score_desc,
+                                        pep_fdr_type="peptide-only", threshold="q-value")
+    peptides = results.confidence_estimates['peptides']
+    targets = psms[psms['target/decoy']].sort_values(reader.score_column, ascending=not reader.score_desc)\
+        .drop_duplicates(['scan_id', 'sequence'])
+    return peptides.merge(targets[['scan_id', 'sequence', 'charge', 'peptide mass', 'experimentalMassToCharge', 'calculatedMassToCharge']],
+                          how="inner", on=['scan_id', 'sequence']).reset_index(drop=True)
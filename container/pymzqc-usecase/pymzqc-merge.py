@@ -1,10 +1,23 @@
 #!/usr/local/bin/python
 import logging
+import warnings
+from fnmatch import fnmatch
+from numbers import Number
+from typing import Dict, List, Tuple
+import numpy as np
 import pandas as pd
+from scipy import sparse
 from mzqc import MZQCFile as qc
 import click
 from itertools import groupby
 from itertools import chain
+from mzqc_validation import post_write_validation, SCHEMA_URL
+
+MAX_VECTOR_LEN = 8  # list values up to this length (e.g. ranges, quarters) are aggregated element-wise
+# table columns holding identifications, compared between the runs of a set
+ID_COLUMNS = {'MS:1003169': "proforma peptidoform sequence",
+              'MS:1000888': "stripped peptide sequence",
+              'MS:1000885': "protein accession"}
 
 def print_help():
     """
@@ -29,7 +42,9 @@ def dedupe(list_of_cvparam_like):
     elif all([isinstance(x, qc.InputFile) for x in list_of_cvparam_like]):
         return list({x.name: x for x in list_of_cvparam_like}.values())
     else:
-        return list({x.accession: x for x in list_of_cvparam_like}.values())
+        # the same metric may be given for different conditions, e.g. FDR thresholds, distinguished by description
+        # placeholder accessions (e.g. 'MS:4000xxx') are only distinguished by name
+        return list({(x.accession, x.name, x.description): x for x in list_of_cvparam_like}.values())
 
 def merge_into_single_run(runs):
     """
@@ -52,7 +67,159 @@ def merge_into_single_run(runs):
         qualityMetrics=metrics)
 
 def match_and_merge_sets_files(sets):
-    pass
+    """
+    merge set quality objects describing the same set
+    sets are considered the same if their labels match, or, if unlabeled, their input file names match
+    returns the merged sets in order of first occurrence
+    """
+    matched = dict()
+    for s in sets:
+        key = s.metadata.label if s.metadata.label != '' else frozenset(x.name for x in s.metadata.inputFiles)
+        matched.setdefault(key, list()).append(s)
+
+    merged = list()
+    for key, group in matched.items():
+        metrics = dedupe(list(chain.from_iterable([x.qualityMetrics for x in group])))
+        asw = dedupe(list(chain.from_iterable([x.metadata.analysisSoftware for x in group])))
+        inf = dedupe(list(chain.from_iterable([x.metadata.inputFiles for x in group])))
+        merged.append(qc.SetQuality(metadata=qc.MetaDataParameters(
+                label=group[0].metadata.label, inputFiles=inf, analysisSoftware=asw),
+            qualityMetrics=metrics))
+    return merged
+
+def group_runs(runs, groups: List[Tuple[str,str]]):
+    """
+    create (metric-less) set qualities from (label, pattern) pairs,
+    runs are members if the name of their first input file matches the pattern (fnmatch style)
+    """
+    sets = list()
+    for label, pattern in groups:
+        members = [r for r in runs if fnmatch(r.metadata.inputFiles[0].name, pattern)]
+        if not members:
+            logging.warning("No run matches the group {} ({}).".format(label, pattern))
+            continue
+        sets.append(qc.SetQuality(metadata=qc.MetaDataParameters(label=label,
+                inputFiles=dedupe([r.metadata.inputFiles[0] for r in members]),
+                analysisSoftware=dedupe(list(chain.from_iterable([r.metadata.analysisSoftware for r in members])))),
+            qualityMetrics=[]))
+    return sets
+
+def stack_metric_values(runs) -> Tuple[Dict, Dict]:
+    """
+    collect the metric values of all runs once and stack them per metric into NumPy arrays:
+        - numeric values (scalars and short lists) into a runs x elements float matrix, missing as NaN
+        - identification table columns (see ID_COLUMNS) into a sparse runs x identifications 0/1 indicator matrix
+    metrics are keyed by (accession, name, description), numeric ones come with their unit
+    """
+    numeric = dict()
+    units = dict()
+    ids = dict()
+    for i, run in enumerate(runs):
+        for m in run.qualityMetrics:
+            key = (m.accession, m.name, m.description)
+            units.setdefault(key, m.unit)
+            v = m.value
+            if isinstance(v, Number) and not isinstance(v, bool):
+                numeric.setdefault(key, (list(), list()))
+                numeric[key][0].append(i)
+                numeric[key][1].append([v])
+            elif isinstance(v, list) and 0 < len(v) <= MAX_VECTOR_LEN and all(isinstance(x, Number) and not isinstance(x, bool) for x in v):
+                numeric.setdefault(key, (list(), list()))
+                numeric[key][0].append(i)
+                numeric[key][1].append(v)
+            elif isinstance(v, dict):
+                for col in ID_COLUMNS.keys() & v.keys():
+                    ids.setdefault(key + (col,), (list(), list()))
+                    ids[key + (col,)][0].append(np.full(len(v[col]), i))
+                    ids[key + (col,)][1].append(np.asarray(v[col], dtype=str))
+
+    stacked = dict()
+    for key, (rows, values) in numeric.items():
+        if len({len(v) for v in values}) > 1:
+            logging.debug("Skipping metric {} with values of different length.".format(key[:2]))
+            continue
+        mat = np.full((len(runs), len(values[0])), np.nan)
+        mat[np.asarray(rows)] = np.asarray(values, dtype=float)
+        stacked[key] = (mat, units[key])
+
+    present = dict()
+    for key, (rows, values) in ids.items():
+        rows = np.concatenate(rows)
+        uniq, inverse = np.unique(np.concatenate(values), return_inverse=True)
+        # only the identifications present are stored, repeated ones (e.g. several spectra) count once
+        mat = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, inverse.ravel())), shape=(len(runs), len(uniq)))
+        mat.sum_duplicates()
+        mat.data[:] = 1
+        present[key] = mat
+    return stacked, present
+
+def aggregate_set_metrics(set_quality, runs, stacked: Dict, present: Dict) -> List[qc.QualityMetric]:
+    """
+    compute the set metrics of a set over its member runs (matched by input file names):
+    per metric the median and the coefficient of variation (sd/mean) as 'median of <name>' and
+    'coefficient of variation of <name>' (placeholder accession), and per identification column
+    the number of identifications in all/any of the runs and their mean pairwise overlap (Jaccard index)
+    """
+    names = {x.name for x in set_quality.metadata.inputFiles}
+    members = np.asarray([any(x.name in names for x in r.metadata.inputFiles) for r in runs])
+    n = int(members.sum())
+    if n == 0:
+        return []
+
+    def described(what, description):
+        return "{} of the runs in the set".format(what) + ("; {}".format(description) if description else '')
+
+    def plain(arr):
+        vals = [None if np.isnan(x) else float(x) for x in arr]
+        return vals[0] if len(vals) == 1 else vals
+
+    metrics = list()
+    for (acc, name, description), (mat, unit) in stacked.items():
+        sub = mat[members]
+        n_valid = (~np.isnan(sub)).sum(axis=0)
+        if not n_valid.any():
+            continue
+        with warnings.catch_warnings():
+            # columns without (enough) values result in NaN, reported as null
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(sub, axis=0)
+            mean = np.nanmean(sub, axis=0)
+            cv = np.where((n_valid > 1) & (mean != 0), np.nanstd(sub, axis=0, ddof=1) / mean, np.nan)
+        # placeholder terms of their own, so they are not taken for the run metric (e.g. when selected by accession)
+        what = "{} ({})".format(acc, name)
+        metrics.append(qc.QualityMetric(accession="MS:4000xxx", name="median of {}".format(name),
+                                        description=described(what, description), value=plain(median), unit=unit))
+        if (n_valid > 1).any():
+            metrics.append(qc.QualityMetric(accession="MS:4000xxx", name="coefficient of variation of {}".format(name),
+                                            description=described(what, description), value=plain(cv)))
+
+    for (acc, name, description, col), mat in present.items():
+        sub = mat[np.flatnonzero(members)]
+        runs_per_id = np.asarray(sub.sum(axis=0)).ravel()
+        what = "{} of {}".format(ID_COLUMNS[col], name)
+        metrics.append(qc.QualityMetric(accession="MS:4000xxx", name="identifications in all runs",
+                                        description=described(what, description), value=int((runs_per_id == n).sum())))
+        metrics.append(qc.QualityMetric(accession="MS:4000xxx", name="identifications in any run",
+                                        description=described(what, description), value=int((runs_per_id > 0).sum())))
+        if n > 1:
+            counts = np.asarray(sub.sum(axis=1)).ravel()
+            # pairwise intersections from the sparse product, only the runs x runs result is dense
+            shared = (sub @ sub.T).toarray()
+            union = counts[:, None] + counts[None, :] - shared
+            jaccard = np.divide(shared, union, out=np.zeros(shared.shape), where=union > 0)
+            pairs = np.triu_indices(n, k=1)
+            metrics.append(qc.QualityMetric(accession="MS:4000xxx", name="mean pairwise identification overlap",
+                                            description=described(what, description), value=float(jaccard[pairs].mean())))
+    return metrics
+
+def parse_groups(ctx, param, value):
+    groups = list()
+    for g in value:
+        label, sep, pattern = g.partition('=')
+        if not sep or not label or not pattern:
+            raise click.BadParameter("Groups must be given as LABEL=PATTERN, got '{}'.".format(g))
+        groups.append((label, pattern))
+    return groups
 
 @click.version_option('v1BETA')
 @click.command(short_help='A simple mzQC file merger using pymzqc assuming file metadata is compatible. mzQC files will be merged, where possible runs matched and metrics combined.')
@@ -61,10 +228,13 @@ def match_and_merge_sets_files(sets):
 @click.option('--compare', type=click.Choice(['metadata', 'location', 'name'], case_sensitive=False),
     default='metadata', show_default=True,
     required=False, help="Level of comparison determining which run's metrics need to be merged into one run. For `metadata`, whole metadata objects must be the same, for `location` the location attributes must be the same, and for `name` only the name attribute must be the same.")
+@click.option('--group', 'groups', multiple=True, callback=parse_groups, help="Define a set of runs as LABEL=PATTERN, runs whose (first) input file name matches the fnmatch PATTERN are members, e.g. 'DMSO=*_DMSO_*' (repeatable). Set metrics are computed for these and all sets given in the inputs.")
+@click.option('--validate', is_flag=True, show_default=True, default=False, help="Validate the merged mzQC against the mzQC schema and PSI-MS CV terms, issues are logged as warnings.")
+@click.option('--schema', show_default=True, default=SCHEMA_URL, help="Path or URL of the mzQC JSON schema used with --validate.")
 @click.option('--log', type=click.Choice(['debug', 'info', 'warn'], case_sensitive=False),
     default='warn', show_default=True,
     required=False, help="Log detail level. (verbosity: debug>info>warn)")
-def merge_mzqc_files(mzqc_output, mzqc_input, compare, log):
+def merge_mzqc_files(mzqc_output, mzqc_input, compare, groups, validate, schema, log):
     # set loglevel - switch to match-case for py3.10+
     lev = {'debug': logging.DEBUG,
      'info': logging.INFO,
@@ -75,6 +245,7 @@ def merge_mzqc_files(mzqc_output, mzqc_input, compare, log):
     cname = set()
     caddress = set()
     to_merge = list()
+    sets = list()
     for fn in mzqc_input:
         with open(fn, "r") as file:
             mzqc = qc.JsonSerialisable.FromJson(file)
@@ -82,11 +253,9 @@ def merge_mzqc_files(mzqc_output, mzqc_input, compare, log):
             cvs.extend(mzqc.controlledVocabularies)
             cname.add(mzqc.contactName)
             caddress.add(mzqc.contactAddress)
-            if len(mzqc.setQualities)>0:
-                # stop if there are msetQualities in either file - we don't cover that here yet - see match_and_merge_sets_files
-                raise IndexError("Cannot merge mzqc with sets yet!")
+            sets.extend(mzqc.setQualities)
 
-    if len(to_merge) < 2:
+    if len(to_merge) + len(sets) < 2:
         raise IndexError("Need at least 2 mzQC files to merge!")
         
     merged = list()
@@ -112,6 +281,13 @@ def merge_mzqc_files(mzqc_output, mzqc_input, compare, log):
         for key, group in groupby(to_merge, lambda x: x.metadata.inputFiles[0].name):
                 merged.append(merge_into_single_run(list(group)))
 
+    merged_sets = match_and_merge_sets_files(sets + group_runs(merged, groups))
+    if merged_sets:
+        stacked, present = stack_metric_values(merged)
+        merged_sets = match_and_merge_sets_files(merged_sets + [
+            qc.SetQuality(metadata=s.metadata, qualityMetrics=aggregate_set_metrics(s, merged, stacked, present))
+            for s in merged_sets])
+
     with open(mzqc_output, "w") as file:
         file.write(qc.JsonSerialisable.ToJson(
             qc.MzQcFile(description="Merged from multiple mzqc files", 
@@ -119,7 +295,11 @@ def merge_mzqc_files(mzqc_output, mzqc_input, compare, log):
                         contactAddress='+'.join(caddress),
                         version="v1.0",
                         controlledVocabularies=dedupe(cvs), 
-                        runQualities=merged), readability=1))
+                        runQualities=merged,
+                        setQualities=merged_sets), readability=1))
+
+    if validate:
+        post_write_validation(mzqc_output, schema)
     
     click.echo("Files merged. Thank you for doing QC!")
 
@@ -7,19 +7,109 @@ import tempfile
 from lxml import etree
 from pyteomics import mzml, parser as fastaparser
 from typing import List, Dict, Union, Tuple, Any
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 import pronto
 from datetime import datetime, timedelta
 import hashlib
+import base64
+import zlib
 from mzqc import MZQCFile as qc
 import click
 import logging
-import crema
+from mzqc_validation import post_write_validation, SCHEMA_URL
+from psm_readers import PsmReader, TideReader, READERS, ENGINES, CHUNKSIZE, assign_qvalues
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 INFO = '''
 A simple QC metric calculator in python using pymzqc to write mzQC output. 
 '''
+# How the spectrum pass treats the binary arrays:
+#  decode - pyteomics decodes all arrays (peak count and intensity sum from the decoded intensity array)
+#  raw    - no array is decoded by pyteomics, peak count from defaultArrayLength, intensity sum from the raw intensity buffer
+#  skip   - no array work at all, peak count from defaultArrayLength, intensity sum is not available (NaN)
+#  tic    - as skip, but the intensity sum is taken from the raw buffer for spectra without a 'total ion current' (for the TIC)
+ARRAY_MODES = ['decode', 'raw', 'skip', 'tic']
+# column types of the spectrum pass results, 'S' columns are (growing width) byte strings
+SPECTRUM_COLUMNS = {'RT': 'f8', 'native_id': 'S', 'peakcount': 'i8', 'int_sum': 'f8', 'traptime': 'f8', 'ms_level': 'i2',
+	'precursor_int': 'f8', 'precursor_c': 'f8', 'precursor_mz': 'f8', 'activation_method': 'S', 'activation_energy': 'f8',
+	'isolation_window_target_mz': 'f8', 'isolation_window_lower_offset': 'f8', 'isolation_window_upper_offset': 'f8',
+	'scan_window_lower': 'f8', 'scan_window_upper': 'f8', 'tic': 'f8'}
+
+class TypedColumn:
+	"""
+	A preallocated numpy column that doubles its capacity when full, 
+	optionally backed by a memory-mapped file (for runs with more spectra than fit in memory).
+	"""
+	def __init__(self, dtype: str, capacity: int = 1 << 16, path: str = None):
+		self.path = path
+		self.generation = 0
+		self.n = 0
+		self.data = self._allocate(np.dtype('S1' if dtype == 'S' else dtype), capacity)
+
+	def _allocate(self, dtype: np.dtype, capacity: int) -> np.ndarray:
+		if self.path is None:
+			return np.zeros(capacity, dtype=dtype)
+		self.generation += 1
+		return np.memmap("{}.{}".format(self.path, self.generation), dtype=dtype, mode='w+', shape=(capacity,))
+
+	def _reallocate(self, dtype: np.dtype, capacity: int):
+		old = self.data
+		self.data = self._allocate(dtype, capacity)
+		self.data[:self.n] = old[:self.n]
+		if isinstance(old, np.memmap):
+			old_path = old.filename
+			del old
+			os.remove(old_path)
+
+	def append(self, value: Any):
+		if self.data.dtype.kind == 'S':
+			value = b'' if not isinstance(value, str) else value.encode()
+			if len(value) > self.data.dtype.itemsize:
+				self._reallocate(np.dtype('S{}'.format(len(value))), self.data.shape[0])
+		if self.n == self.data.shape[0]:
+			self._reallocate(self.data.dtype, 2 * self.data.shape[0])
+		self.data[self.n] = value
+		self.n += 1
+
+	@property
+	def values(self) -> np.ndarray:
+		return self.data[:self.n]
+
+class SpectrumColumns:
+	"""
+	Typed column store the spectrum pass writes into directly, used like the dict of lists it replaces 
+	(`columns['RT'].append(rt)`); unknown columns are created as float columns.
+	With a scratch_dir, all columns are memory-mapped files in a temporary directory there.
+	"""
+	def __init__(self, dtypes: Dict[str,str], scratch_dir: str = None, capacity: int = 1 << 16):
+		self.capacity = capacity
+		self.tmpdir = tempfile.TemporaryDirectory(dir=scratch_dir) if scratch_dir else None
+		self.columns: Dict[str,TypedColumn] = dict()
+		for name, dtype in dtypes.items():
+			self._add(name, dtype)
+
+	def _add(self, name: str, dtype: str) -> TypedColumn:
+		path = os.path.join(self.tmpdir.name, name) if self.tmpdir else None
+		self.columns[name] = TypedColumn(dtype, self.capacity, path)
+		return self.columns[name]
+
+	def __getitem__(self, name: str) -> TypedColumn:
+		return self.columns[name] if name in self.columns else self._add(name, 'f8')
+
+	def frame(self) -> pd.DataFrame:
+		"""
+		DataFrame with the numeric columns as views (no copy) on the store, 
+		byte string columns are decoded into (object) str columns with missing values as NaN
+		"""
+		cols = dict()
+		for name, col in self.columns.items():
+			if col.data.dtype.kind == 'S':
+				strs = col.values.astype(str).astype(object)
+				strs[strs == ''] = np.nan
+				cols[name] = strs
+			else:
+				cols[name] = col.values
+		return pd.DataFrame(cols, copy=False)
 
 @dataclass
 class Run:
@@ -28,13 +118,17 @@ class Run:
 	completion_time: datetime = datetime.now()
 	base_df: pd.DataFrame = pd.DataFrame()
 	id_df: pd.DataFrame = pd.DataFrame()
+	id_qvalue_df: pd.DataFrame = pd.DataFrame()  # all target identifications with their crema q-value
 	mzml_path: str = ""
 	tide_target_file: str = ""  # tide-search target results file
 	tide_decoy_file: str = ""  # tide-search decoy results file
 	tide_td_pair_file: str = ""  # tide-index target|decoy pair file
-	crema_fdr: int = 100  # FDR chosen for crema confidence filter
+	psm_reader: PsmReader = None  # search engine backend the identifications were read with
+	crema_fdr: float = 100  # FDR chosen for crema confidence filter
 	instrument_type: pronto.Term = None
+	ontology: pronto.Ontology = None  # PSI-MS CV as loaded for the instrument type, reused for validation
 	checksum: str = ""
+	spectrum_columns: SpectrumColumns = None  # storage base_df is a view on
 
 def print_help():
 	"""
@@ -45,7 +139,7 @@ def print_help():
 	click.echo(ctx.get_help())
 	ctx.exit()
 
-def pad_lists(listdict: Dict[str,List[Any]], padlist: List[str]): 
+def pad_lists(listdict: SpectrumColumns, padlist: List[str]): 
 	"""
 	helper function to make mzML consumption more accessible
 	"""
@@ -109,8 +203,35 @@ def getMassError(theo_mz: float, exp_mz: float, use_ppm: bool = True) -> float:
 		error = error / (theo_mz * 1e-6)
 	return error
 
-def getMetricSourceFramesBase(run: mzml.MzML) -> pd.DataFrame:     
-	data_acquisition: Dict[str,List[Any]] = defaultdict(list)
+def intensitySumFromRecord(record) -> float:
+	"""
+	intensitySumFromRecord sums an undecoded (i.e. read with decode_binary=False) binary array record.
+
+	The base64 (and zlib) decoded buffer is summed in place via np.frombuffer, without the copy pyteomics makes,
+	other compressions (numpress) fall back to the pyteomics decoding.
+
+	Parameters
+	----------
+	record : BinaryDataArrayTransformer.binary_array_record
+			The undecoded intensity array
+
+	Returns
+	-------
+	float
+			The sum of the array values
+	"""
+	if not record.data:
+		return 0.0
+	if record.compression not in ('no compression', 'zlib compression'):
+		return record.decode().sum()
+	buffer = base64.b64decode(record.data)
+	if record.compression == 'zlib compression':
+		buffer = zlib.decompress(buffer)
+	return np.frombuffer(buffer, dtype=record.dtype).sum()
+
+def getMetricSourceFramesBase(run: mzml.MzML, array_mode: str = 'decode', data_acquisition: SpectrumColumns = None) -> pd.DataFrame:     
+	if data_acquisition is None:
+		data_acquisition = SpectrumColumns(SPECTRUM_COLUMNS)
 	mslevelcounts: Dict[int,int] = defaultdict(int)
 	ms2_only_padlist = ['precursor_int','precursor_c','precursor_mz','activation_method','activation_energy','isolation_window_target_mz','isolation_window_lower_offset','isolation_window_upper_offset']
 	for spectrum in run:
@@ -132,17 +253,28 @@ def getMetricSourceFramesBase(run: mzml.MzML) -> pd.DataFrame:
 		actual_min_mz = spectrum['lowest observed m/z']
 		actual_max_mz = spectrum['highest observed m/z']
 
-		rt_sec = next(iter((spectrum['scanList']['scan'])))['scan start time']
+		rt = next(iter((spectrum['scanList']['scan'])))['scan start time']
+		# pyteomics keeps the mzML's unit (ThermoRawFileParser writes minutes), RT is in seconds throughout
+		rt_sec = rt * 60 if getattr(rt, 'unit_info', None) == 'minute' else rt
 		inj_msec = next(iter((spectrum['scanList']['scan'])))['ion injection time']
 
 		mslevelcounts[spectrum['ms level']] += 1
 	
 		data_acquisition['RT'].append(rt_sec)
 		data_acquisition['native_id'].append(nid)
-		data_acquisition['peakcount'].append(spectrum['intensity array'].size)
-		data_acquisition['int_sum'].append(spectrum['intensity array'].sum())
+		if array_mode == 'decode':
+			data_acquisition['peakcount'].append(spectrum['intensity array'].size)
+			data_acquisition['int_sum'].append(spectrum['intensity array'].sum())
+		else:
+			data_acquisition['peakcount'].append(spectrum['defaultArrayLength'])
+			int_sum = array_mode == 'raw' or (array_mode == 'tic' and 'total ion current' not in spectrum)
+			data_acquisition['int_sum'].append(intensitySumFromRecord(spectrum['intensity array']) if int_sum else np.nan)
 		data_acquisition['traptime'].append(inj_msec)
 		data_acquisition['ms_level'].append(spectrum['ms level'])
+		data_acquisition['scan_window_lower'].append(preset_min_mz)
+		data_acquisition['scan_window_upper'].append(preset_max_mz)
+		# the spectrum's TIC param spares the intensity array, if present
+		data_acquisition['tic'].append(spectrum.get('total ion current', data_acquisition['int_sum'].values[-1]))
 
 		if "MSn spectrum" in spectrum:
 			if len(spectrum["precursorList"]['precursor']) < 1:
@@ -167,13 +299,14 @@ def getMetricSourceFramesBase(run: mzml.MzML) -> pd.DataFrame:
 		else:
 			pad_lists(data_acquisition, ms2_only_padlist)
 		
-	return pd.DataFrame(data_acquisition)
+	return data_acquisition.frame()
 
-def load_mzml(mzml_path: str) -> Run:
+def load_mzml(mzml_path: str, array_mode: str = 'decode', scratch_dir: str = None) -> Run:
 	name = os.path.splitext(os.path.basename(mzml_path))[0]
 
-	with mzml.read(mzml_path) as reader:
-		base = getMetricSourceFramesBase(reader)
+	columns = SpectrumColumns(SPECTRUM_COLUMNS, scratch_dir)
+	with mzml.read(mzml_path, decode_binary=(array_mode == 'decode')) as reader:
+		base = getMetricSourceFramesBase(reader, array_mode, columns)
 	base["scan_id"] = base.native_id.str.extract("scan=(\d+)$").astype(int)
 
 	# some things need to come from the mzml directly via xpath
@@ -194,41 +327,62 @@ def load_mzml(mzml_path: str) -> Run:
 	cmplt = strt + timedelta(seconds=base["RT"].max())
 	chksm = sha256fromfile(mzml_path)
 
-	return Run(run_name=name, start_time=strt, completion_time=cmplt, base_df=base, mzml_path=mzml_path, instrument_type=itype, checksum=chksm)
-
-def load_ids(run: Run, crux_tide_index:str, crux_tide_search:str, tide_index:str, tide_search:str, fdr: int=1) -> Run:
-	tide_target_file = os.path.join(crux_tide_search,tide_search+'.target.txt')
-	tide_decoy_file = os.path.join(crux_tide_search,tide_search+'.decoy.txt')
-	tide_td_pair_file = os.path.join(crux_tide_index,tide_index)
-	psms = crema.read_tide([tide_target_file, tide_decoy_file], 
-						pairing_file_name=tide_td_pair_file,
-						decoy_prefix='DECOY_')
-	results =  psms.assign_confidence(score_column="xcorr score", desc=True, pep_fdr_type="peptide-only", threshold=fdr/100)
-	with tempfile.TemporaryDirectory() as tmpdirname:
-		results.to_txt(output_dir=tmpdirname, file_root="simp", sep="\t", decoys=False)
-		prt_df = pd.read_csv(tmpdirname+"/simp.crema.proteins.txt", sep="\t")
-		pep_df = pd.read_csv(tmpdirname+"/simp.crema.peptides.txt", sep="\t").rename(columns={"scan": "scan_id"})
+	return Run(run_name=name, start_time=strt, completion_time=cmplt, base_df=base, mzml_path=mzml_path, instrument_type=itype, ontology=ms, checksum=chksm, spectrum_columns=columns)
 
-	pep_df = pep_df.merge(pd.read_csv(os.path.join(crux_tide_search,tide_search+'.target.txt'), sep="\t").rename(columns={"scan": "scan_id"})[['scan_id','charge','peptide mass', 'spectrum precursor m/z']], how="inner", on='scan_id').rename(columns={"spectrum precursor m/z": "experimentalMassToCharge"})
-	pep_df['calculatedMassToCharge'] = pep_df['peptide mass']/pep_df['charge']
+def psm_reader(psm_format: str, id_input: Tuple[str], tide_index: str, tide_search: str, decoy_prefix: str, 
+			   engine: str = 'c', chunksize: int = CHUNKSIZE) -> PsmReader:
+	"""
+	psm_reader creates the search engine backend for the identification input, 
+	which is the crux tide-index and tide-search directories for `tide`, and the result files otherwise
+	"""
+	if psm_format == 'tide':
+		if len(id_input) != 2:
+			raise ValueError("Tide identifications need the crux tide-index and tide-search directories as input.")
+		crux_tide_index, crux_tide_search = id_input
+		files = [os.path.join(crux_tide_search,tide_search+'.target.txt'), os.path.join(crux_tide_search,tide_search+'.decoy.txt')]
+		return TideReader(files, pairing_file=os.path.join(crux_tide_index,tide_index), 
+							decoy_prefix=decoy_prefix, chunksize=chunksize, engine=engine)
+	return READERS[psm_format](list(id_input), decoy_prefix=decoy_prefix, chunksize=chunksize, engine=engine)
+
+def load_ids(run: Run, reader: PsmReader, fdr: float=1) -> Run:
+	run.id_qvalue_df = assign_qvalues(reader)
+	run.psm_reader = reader
+	if isinstance(reader, TideReader):
+		run.tide_target_file, run.tide_decoy_file = reader.files
+		run.tide_td_pair_file = reader.pairing_file
+	return ids_at_fdr(run, fdr)
+
+def ids_at_fdr(run: Run, fdr: float) -> Run:
+	"""
+	ids_at_fdr derives the accepted identifications at the given FDR [%] from the identification q-values.
 
-	run.tide_target_file = tide_target_file
-	run.tide_decoy_file = tide_decoy_file
-	run.tide_td_pair_file = tide_td_pair_file
-	run.crema_fdr = fdr
+	Parameters
+	----------
+	run : Run
+			The run with identifications loaded by load_ids
+	fdr : float
+			The FDR threshold in percent
 
-	run.id_df = pep_df[pep_df['accept']==True]
-	return run
+	Returns
+	-------
+	Run
+			A shallow copy of the run with id_df restricted to the identifications accepted at fdr
+	"""
+	qvalues = run.id_qvalue_df['crema q-value']
+	return replace(run, id_df=run.id_qvalue_df[qvalues <= fdr/100], crema_fdr=fdr)
 
 def construct_mzqc(run: Run, quality_metric_values: List[qc.QualityMetric]):
 	infi1 = qc.InputFile(name=run.mzml_path, location=run.mzml_path, fileFormat=qc.CvParameter("MS:1000584", "mzML format"))
 	infi1.fileProperties.append(qc.CvParameter("MS:1003151", "SHA-256", run.checksum))
 	infi1.fileProperties.append(qc.CvParameter(run.instrument_type.id, run.instrument_type.name))
 	infi1.fileProperties.append(qc.CvParameter("MS:1000747", "completion time", run.completion_time))
-	infi2 = qc.InputFile(name=run.tide_target_file, location=run.tide_target_file, fileFormat=qc.CvParameter("MS:1000914", "tab delimited text format"))
-	anso1 = qc.AnalysisSoftware(accession="MS:1002575", name="Tide", version="4.2", uri="https://crux.ms/")
+	# for tide, only the target results are listed as before
+	id_files = run.psm_reader.files[:1] if isinstance(run.psm_reader, TideReader) else run.psm_reader.files
+	infi2 = [qc.InputFile(name=f, location=f, fileFormat=qc.CvParameter(*run.psm_reader.file_format)) for f in id_files]
+	acc, name, version, uri = run.psm_reader.software
+	anso1 = qc.AnalysisSoftware(accession=acc, name=name, version=version, uri=uri)
 	anso2 = qc.AnalysisSoftware(accession="MS:1003357", name="simple qc metric calculator", version="0", uri="https://github.com/MS-Quality-Hub/mzqclib-manuscript")
-	meta = qc.MetaDataParameters(inputFiles=[infi1, infi2],analysisSoftware=[anso1, anso2], label="implementation-case demo")
+	meta = qc.MetaDataParameters(inputFiles=[infi1, *infi2],analysisSoftware=[anso1, anso2], label="implementation-case demo")
 	rq = qc.RunQuality(metadata=meta, qualityMetrics=quality_metric_values)
 	cv = qc.ControlledVocabulary(name="PSI-MS", uri="https://github.com/HUPO-PSI/psi-ms-CV/releases/download/v4.1.130/psi-ms.obo", version="v4.1.130")
 	mzqc = qc.MzQcFile(version="1.0.0", description="Demo mzQC created from a simple qc metric calculator", contactName="mwalzer", 
@@ -301,19 +455,68 @@ def calc_metric_idcounts(run) -> Tuple[qc.QualityMetric]:
 							value= int(ids_only['protein id'].nunique()))
 	return peptide_id,accession_id
 
+def nan_to_none(values: np.ndarray) -> List[Any]:
+	"""
+	NaN is not valid JSON, missing values are written as null
+	"""
+	return [None if np.isnan(v) else v for v in values.tolist()]
+
+def calc_metric_tic(run, rt_bins: int = 0) -> qc.QualityMetric:
+	ms1 = run.base_df[run.base_df['ms_level'] == 1]
+	rt = ms1['RT'].to_numpy()
+	tic = ms1['tic'].to_numpy()
+	if np.isnan(tic).all() and tic.size > 0:
+		logging.warn("No TIC in the mzML spectra, use --arrays tic to calculate it from the intensity arrays.")
+	if rt_bins and rt.size > rt_bins:
+		# downsample to mean TIC and RT of equally wide RT bins
+		edges = np.linspace(rt.min(), rt.max(), rt_bins + 1)
+		idx = np.clip(np.searchsorted(edges, rt, side='right') - 1, 0, rt_bins - 1)
+		counts = np.bincount(idx, minlength=rt_bins)
+		filled = counts > 0
+		value = {"MS:1000285": nan_to_none(np.bincount(idx, tic, rt_bins)[filled] / counts[filled]),
+				"MS:1000894": (np.bincount(idx, rt, rt_bins)[filled] / counts[filled]).tolist()}
+	else:
+		value = {"MS:1000285": nan_to_none(tic),
+				"MS:1000894": rt.tolist(),
+				"MS:1000767": ms1['native_id'].to_list(),
+				"MS:1003059": ms1['peakcount'].to_list()}
+	metric_value = qc.QualityMetric(accession="MS:4000104", name="total ion currents", value=value)
+	return metric_value
+
+def calc_metric_ranges(run) -> Tuple[qc.QualityMetric]:
+	mz_range = qc.QualityMetric(accession="MS:4000069", 
+							name="m/z acquisition range", 
+							value=[float(run.base_df['scan_window_lower'].min()), float(run.base_df['scan_window_upper'].max())])
+	rt_range = qc.QualityMetric(accession="MS:4000070", 
+							name="retention time acquisition range", 
+							value=[float(run.base_df['RT'].min()), float(run.base_df['RT'].max())],
+							unit=qc.CvParameter(accession="UO:0000010", name="second"))
+	return mz_range, rt_range
+
 @click.command(short_help='correct_mgf_tabs will correct the peak data tab separation in any spectra of the mgf')
 @click.argument('mzml_input', type=click.Path(exists=True,readable=True) )  # help="The file with the spectra to analyse"
-@click.argument('crux_tide_index', type=click.Path(exists=True,readable=True) )  # help="The file with the spectrum identifications to analyse"
-@click.argument('crux_tide_search', type=click.Path(exists=True,readable=True) )  # help="The file with the spectrum identifications to analyse"
+@click.argument('id_input', nargs=-1, type=click.Path(exists=True,readable=True) )  # help="The spectrum identifications to analyse: crux tide-index and tide-search directories, or the result files (see --psm_format)"
 @click.argument('mzqc_output', type=click.Path(writable=True, dir_okay=False) )  # help="The output path for the resulting mzqc"
-@click.option('--fdr', show_default=True, default=1, help="The FDR value in percent.")
+@click.option('--fdr', multiple=True, type=float, show_default=True, default=[1], help="The FDR value in percent. Repeat for metrics at several FDR thresholds (e.g. --fdr 0.1 --fdr 1 --fdr 5), identifications are loaded only once.")
 @click.option('--tide_index', show_default=True, default="tide-index.peptides.txt", help="The tide index peptide-pair filename. (Needs to be inside the tide-index directory!)")
 @click.option('--tide_search', show_default=True, default="tide-search", help="The tide search file name root (ending in .target.txt and .decoy.txt respectively).")
+@click.option('--psm_format', type=click.Choice(list(READERS), case_sensitive=False), default='tide', show_default=True,
+	help="Search engine results format: crux `tide` (ID_INPUT are the tide-index and tide-search directories), Comet tab-delimited `comet` or Comet `pepxml` (ID_INPUT are the result files of concatenated target-decoy searches).")
+@click.option('--decoy_prefix', show_default=True, default="DECOY_", help="The decoy protein accession prefix.")
+@click.option('--csv_engine', type=click.Choice(ENGINES, case_sensitive=False), default='c', show_default=True,
+	help="Parser for tab-delimited results: chunked pandas `c`, or the multithreaded `pyarrow` (needs pyarrow).")
+@click.option('--validate', is_flag=True, show_default=True, default=False, help="Validate the written mzQC against the mzQC schema and PSI-MS CV terms, issues are logged as warnings.")
+@click.option('--schema', show_default=True, default=SCHEMA_URL, help="Path or URL of the mzQC JSON schema used with --validate.")
+@click.option('--arrays', type=click.Choice(['auto', *ARRAY_MODES], case_sensitive=False), default='auto', show_default=True,
+	help="Binary array handling in the spectrum pass: `decode` all arrays, `raw` sums intensities from the undecoded buffer and never decodes m/z, `skip` does no array work, `tic` sums raw intensities only of spectra without TIC param. `auto` is `tic` unless array derived values are exported (--dev, `raw`).")
+@click.option('--tic_bins', type=click.IntRange(min=0), show_default=True, default=0, help="Downsample the TIC metric to this many retention time bins (0 keeps all MS1 spectra).")
+@click.option('--scratch', type=click.Path(exists=True, file_okay=False, writable=True), required=False,
+	help="Directory (local scratch) for memory-mapped spectrum columns, instead of keeping them in memory.")
 @click.option('--dev', is_flag=True, show_default=True, default=False, help="Add dataframes to the mzQC (as unofficial 'metrics', which produces a pymzqc readable though non-standard-conform mzqc file).")
 @click.option('--log', type=click.Choice(['debug', 'info', 'warn'], case_sensitive=False),
 	default='warn', show_default=True,
 	required=False, help="Log detail level. (verbosity: debug>info>warn)")
-def simple_qc_metric_calculator(mzml_input, crux_tide_index, crux_tide_search, mzqc_output, fdr, tide_index, tide_search, dev, log):
+def simple_qc_metric_calculator(mzml_input, id_input, mzqc_output, fdr, tide_index, psm_format, decoy_prefix, csv_engine, tide_search, validate, schema, arrays, tic_bins, scratch, dev, log):
 	"""
 	main function controlling command-line call parameters and calling high-level functions
 	"""
@@ -323,16 +526,30 @@ def simple_qc_metric_calculator(mzml_input, crux_tide_index, crux_tide_search, m
 		'warn': logging.WARN }
 	logging.basicConfig(format='%(levelname)s:%(message)s', level=lev[log])
 
+	# the metrics use the intensity sums only for spectra without TIC, the exported base data frame uses all
+	if arrays == 'auto':
+		arrays = 'raw' if dev else 'tic'
+
 	try:
-		run = load_mzml(mzml_input)
-		run = load_ids(run, crux_tide_index, crux_tide_search, tide_index, tide_search, fdr)
+		run = load_mzml(mzml_input, arrays, scratch)
+		reader = psm_reader(psm_format, id_input, tide_index, tide_search, decoy_prefix, csv_engine)
+		run = load_ids(run, reader, fdr[0])
 	except Exception as e:
 		click.echo(e)
 		print_help()
 	
-	quality_metric_values = [*calc_metric_deltam(run), calc_metric_ioncollection(run), 
-						  calc_metric_missedcleavage(run), *calc_metric_idrate(run),
-						  *calc_metric_idcounts(run), calc_metric_idrtquarters(run)]
+	quality_metric_values = list()
+	for threshold in sorted(set(fdr)):
+		run_at_fdr = ids_at_fdr(run, threshold)
+		id_count, ms2_count = calc_metric_idrate(run_at_fdr)
+		id_metrics = [*calc_metric_deltam(run_at_fdr), calc_metric_ioncollection(run_at_fdr), 
+						  calc_metric_missedcleavage(run_at_fdr), id_count,
+						  *calc_metric_idcounts(run_at_fdr), calc_metric_idrtquarters(run_at_fdr)]
+		if len(set(fdr)) > 1:
+			for qm in id_metrics:
+				qm.description = "at {:g}% FDR".format(threshold)
+		quality_metric_values.extend(id_metrics)
+	quality_metric_values.extend([ms2_count, calc_metric_tic(run, tic_bins), *calc_metric_ranges(run)])
 	if dev:
 		for n,df in [("base data frame", run.base_df), ("identifications data frame", run.id_df)]:
 			quality_metric_values.append(
@@ -342,6 +559,9 @@ def simple_qc_metric_calculator(mzml_input, crux_tide_index, crux_tide_search, m
 
 	with open(os.path.join(mzqc_output), "w") as file:
 		file.write(qc.JsonSerialisable.ToJson(mzqc, readability=1))
+
+	if validate:
+		post_write_validation(mzqc_output, schema, [run.ontology])
 	
 if __name__ == '__main__':
 	simple_qc_metric_calculator()
\ No newline at end of file
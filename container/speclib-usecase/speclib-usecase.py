@@ -8,16 +8,24 @@
 
 from mzqc import MZQCFile as qc
 import ann_solo
-from ann_solo import reader, spectral_library
+from ann_solo import reader, spectral_library, utils, writer
 from ann_solo.config import config
+from ann_solo.spectrum import process_spectrum
+import faiss
+import numexpr
 import pandas as pd
 from pyteomics import mztab
+import numpy as np
 import tempfile
 import fileinput
 import sys, os
+import copy
+import collections
+import multiprocessing
 import shutil
 import click
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 #python3 spectre_of_spectra.py ${mgf} ${splib} ${mgf.baseName}.pymzqc.mzqc
 
@@ -47,29 +55,168 @@ def print_help():
     click.echo(ctx.get_help())
     ctx.exit()
 
-def use_ann_solo(speclib_input, mgf_input):
+# search_shard uses ANN-SoLo internals (SpectralLibrary._search_batch, ._library_reader) of this version
+ANN_SOLO_VERSION = "0.3.3"
+ANN_SOLO_SEARCH_PARAMS = dict(
+    precursor_tolerance_mass=20,
+    precursor_tolerance_mode="ppm",
+    fragment_mz_tolerance=0.5,
+)
+
+def parse_ann_solo_config(speclib_input_rw, mgf_input, fdr=0.01):
+    """
+    set ANN-SoLo's (module global) config as ann_solo.ann_solo does for the search, without the output file
+    """
+    args = sum([['--' + k, str(v)] for k, v in ANN_SOLO_SEARCH_PARAMS.items()], [])
+    config.parse([speclib_input_rw, mgf_input, os.devnull, '--fdr', str(fdr), *args])
+
+def limit_threads(threads):
+    """
+    cap the threads of faiss (OpenMP) and numexpr in a search worker, so that workers x threads fit the available cores
+    """
+    faiss.omp_set_num_threads(threads)
+    numexpr.set_num_threads(threads)
+
+def read_query_spectra(mgf_input, shard=0, shards=1):
+    """
+    read the query spectra of an mgf (shard) by charge, as SpectralLibrary.search does, 
+    with their spectrum index in the unsharded mgf (see split_mgf)
+    """
+    query_spectra = collections.defaultdict(list)
+    for query_spectrum in reader.read_mgf(mgf_input):
+        query_spectrum.index = query_spectrum.index * shards + shard
+        if query_spectrum.precursor_charge is not None:
+            query_spectra_charge = [query_spectrum]
+        else:
+            query_spectra_charge = list()
+            for charge in (2, 3):
+                query_spectra_charge.append(copy.copy(query_spectrum))
+                query_spectra_charge[-1].precursor_charge = charge
+        for query_spectrum_charge in query_spectra_charge:
+            if process_spectrum(query_spectrum_charge, False).is_valid:
+                query_spectra[query_spectrum_charge.precursor_charge].append(query_spectrum_charge)
+    return query_spectra
+
+def search_level(spec_lib, query_spectra, mode):
+    """
+    one level ('std' or 'open') of ANN-SoLo's cascade search, as SpectralLibrary._search_cascade but without the FDR filter,
+    returns the best SSM (target or decoy) of each query spectrum
+    """
+    ssms = dict()
+    for charge, query_spectra_charge in query_spectra.items():
+        for i in range(0, len(query_spectra_charge), config.batch_size):
+            for ssm in spec_lib._search_batch(query_spectra_charge[i:i + config.batch_size], charge, mode):
+                if ssm is not None and (ssm.query_identifier not in ssms or
+                        ssm.search_engine_score > ssms[ssm.query_identifier].search_engine_score):
+                    ssms[ssm.query_identifier] = ssm
+    return list(ssms.values())
+
+def open_search_enabled():
+    return config.precursor_tolerance_mass_open is not None and config.precursor_tolerance_mode_open is not None
+
+def search_shard(speclib_input_rw, mgf_input, fdr=0.01, shard=0, shards=1):
+    """
+    run the standard and the open search of all spectra of an mgf (shard) against the (writable copy of the) spectral library,
+    returns the unfiltered SSMs of both levels, the cascade FDR is applied over all shards in cascade_fdr
+    """
+    parse_ann_solo_config(speclib_input_rw, mgf_input, fdr)
+    spec_lib = spectral_library.SpectralLibrary(speclib_input_rw)
+    try:
+        query_spectra = read_query_spectra(mgf_input, shard, shards)
+        return {'std': search_level(spec_lib, query_spectra, 'std'),
+                'open': search_level(spec_lib, query_spectra, 'open') if open_search_enabled() else list()}
+    finally:
+        spec_lib.shutdown()
+
+def cascade_fdr(shard_ssms, fdr=0.01):
+    """
+    ANN-SoLo's cascade FDR over the SSMs of all shards: the standard search SSMs are filtered with filter_fdr,
+    the open search SSMs of the remaining spectra with filter_group_fdr (decoys are removed by both)
+    """
+    identifications = {ssm.query_identifier: ssm for ssm in utils.filter_fdr([ssm for s in shard_ssms for ssm in s['std']], fdr)}
+    logging.info("{} spectra identified after the standard search".format(len(identifications)))
+    if open_search_enabled():
+        remaining = [ssm for s in shard_ssms for ssm in s['open'] if ssm.query_identifier not in identifications]
+        for ssm in utils.filter_group_fdr(remaining, fdr, config.fdr_tolerance_mass, 
+                                          config.fdr_tolerance_mode, config.fdr_min_group_size):
+            identifications[ssm.query_identifier] = ssm
+        logging.info("{} spectra identified after the open search".format(len(identifications)))
+    return list(identifications.values())
+
+def read_identifications(identifications, library_reader):
+    """
+    write the identifications with ANN-SoLo's mzTab writer and return the PSM table of the (patched) mzTab
+    """
+    with tempfile.NamedTemporaryFile(mode='w+', suffix='.mzTab') as mztp:
+        writer.write_mztab(identifications, mztp.name, library_reader)
+        for line in fileinput.input([mztp.name], inplace=True):
+            if line.strip().startswith('PSH'):
+                line = '\t'.join(line.split('\t')[:-1]) + '\n'
+            sys.stdout.write(line)
+        spec_catch = mztab.MzTab(mztp.name)
+    return spec_catch.spectrum_match_table
+
+def split_mgf(mgf_input, shard_dir, shards):
+    """
+    split the mgf into (at most) `shards` files, distributing whole spectra (BEGIN IONS ... END IONS) round-robin,
+    returns the list of shard file paths (mgf extension is mandatory for ANN-SoLo)
+    """
+    base = os.path.splitext(os.path.basename(mgf_input))[0]
+    shard_paths = [os.path.join(shard_dir, "{}.shard{}.mgf".format(base, i)) for i in range(shards)]
+    shard_files = [open(p, 'w') for p in shard_paths]
+    spectra = 0
+    try:
+        with open(mgf_input, 'r') as infile:
+            out = None
+            for line in infile:
+                if line.startswith('BEGIN IONS'):
+                    out = shard_files[spectra % shards]
+                    spectra += 1
+                if out is not None:
+                    out.write(line)
+                if line.startswith('END IONS'):
+                    out = None
+    finally:
+        for f in shard_files:
+            f.close()
+    # do not hand empty shards to ANN-SoLo (mgf with fewer spectra than shards)
+    return shard_paths[:min(spectra, shards)]
+
+def use_ann_solo(speclib_input, mgf_input, shards=1, fdr=0.01):
+    """
+    search the mgf in (concurrently searched) shards, the unsharded search being the single shard case,
+    and apply the cascade FDR once over the SSMs of all shards, so the result does not depend on the number of shards
+    """
+    if ann_solo.__version__ != ANN_SOLO_VERSION:
+        logging.warning("ANN-SoLo {} found, the search relies on internals of version {}.".format(ann_solo.__version__, ANN_SOLO_VERSION))
     with tempfile.TemporaryDirectory() as dir:
         speclib_input_rw =os.path.join(dir,os.path.basename(speclib_input))
         shutil.copy(speclib_input, os.path.join(dir,os.path.basename(speclib_input)))
-        with tempfile.NamedTemporaryFile(mode='w+', suffix='.mzTab') as mztp:
-            res = ann_solo.ann_solo(speclib_input_rw,
-                mgf_input,
-                mztp.name,
-                precursor_tolerance_mass=20,
-                precursor_tolerance_mode="ppm",
-                fragment_mz_tolerance=0.5,
-                fdr=0.01,
-            )
-            for line in fileinput.input([mztp.name], inplace=True):
-                if line.strip().startswith('PSH'):
-                    line = '\t'.join(line.split('\t')[:-1]) + '\n'
-                sys.stdout.write(line)
-            spec_catch = mztab.MzTab(mztp.name)
-    return spec_catch.spectrum_match_table
+        # ANN-SoLo creates its config and ANN index files next to the library on first use,
+        # so this is done here once, before any (concurrent) shard search
+        parse_ann_solo_config(speclib_input_rw, mgf_input, fdr)
+        spec_lib = spectral_library.SpectralLibrary(speclib_input_rw)
+        # the library stays open until the mzTab is written, as in ann_solo's main
+        try:
+            if shards < 2:
+                shard_ssms = [search_shard(speclib_input_rw, mgf_input, fdr)]
+            else:
+                shard_paths = split_mgf(mgf_input, dir, shards)
+                workers = min(len(shard_paths), os.cpu_count() or 1)
+                # spawned workers, OpenMP does not survive a fork after the index creation above
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=limit_threads, initargs=(max(1, (os.cpu_count() or 1) // workers),)) as pool:
+                    shard_ssms = list(pool.map(search_shard, [speclib_input_rw]*len(shard_paths), shard_paths, 
+                                               [fdr]*len(shard_paths), range(len(shard_paths)), [len(shard_paths)]*len(shard_paths)))
+            # the mzTab metadata refers to the unsharded search
+            parse_ann_solo_config(speclib_input_rw, mgf_input, fdr)
+            return read_identifications(cascade_fdr(shard_ssms, fdr), spec_lib._library_reader)
+        finally:
+            spec_lib.shutdown()
 
 def construct_mzqc(run_name, qm):
     infi = qc.InputFile(name=run_name, location=run_name, fileFormat=qc.CvParameter("MS:1001062", "mgf format"))
-    anso = qc.AnalysisSoftware(accession="MS:1003357", name="ANN-SoLo", version="0.3.3", uri="https://github.com/bittremieux/ANN-SoLo")
+    anso = qc.AnalysisSoftware(accession="MS:1003357", name="ANN-SoLo", version=ANN_SOLO_VERSION, uri="https://github.com/bittremieux/ANN-SoLo")
     meta = qc.MetaDataParameters(inputFiles=[infi],analysisSoftware=[anso], label="implementation-case demo")
     rq = qc.RunQuality(metadata=meta, qualityMetrics=[qm])
     # sq = qc.SetQuality(metadata=meta, qualityMetrics=[qm])
@@ -115,10 +262,12 @@ def calc_contaminant_metric(psms):
 @click.argument('output_filepath', type=click.Path(writable=True) )  # help="The output destination path for the resulting mzqc")
 @click.option('-f', '--fig', 'figure', type=click.Path(exists=False,writable=True),
     required=False, help="A visualisation of the contaminant fishing.")
+@click.option('-s', '--shards', type=click.IntRange(min=1), default=1, show_default=True,
+    required=False, help="Split the mgf into this many shards searched concurrently (FDR is applied after merging).")
 @click.option('--log', type=click.Choice(['debug', 'info', 'warn'], case_sensitive=False),
     default='warn', show_default=True,
     required=False, help="Log detail level. (verbosity: debug>info>warn)")
-def fish_for_contaminants(speclib_input, mgf_input, output_filepath, figure, log):
+def fish_for_contaminants(speclib_input, mgf_input, output_filepath, figure, shards, log):
     """
     ...
     """
@@ -131,7 +280,7 @@ def fish_for_contaminants(speclib_input, mgf_input, output_filepath, figure, log
     if not any([speclib_input, mgf_input, output_filepath]):
         print_help()
     try:
-        psms = use_ann_solo(speclib_input, mgf_input)
+        psms = use_ann_solo(speclib_input, mgf_input, shards)
     except Exception as e:
         click.echo(e)
         print_help()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+Longitudinal control charts over a series of mzQC files (e.g. repeated QC standard runs like autoQC).
+Per metric, the state of a rolling window (mean/sd and median/MAD) and an EWMA is kept and saved,
+so a new run is checked against and added to the baseline without re-reading any earlier mzQC.
+Runs are ordered by the `completion time` (MS:1000747) of their first input file.
+"""
+import json
+import math
+import bisect
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set
+import numpy as np
+import click
+from mzqc import MZQCFile as qc
+from study_matrix import base_run_name, metric_columns
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+COMPLETION_TIME = "MS:1000747"
+MAD_SCALE = 1.4826  # MAD to sd for normally distributed values
+
+
+@dataclass
+class MetricState:
+    """
+    running statistics of one metric: the last `window` values with their mean/M2 (Welford add/remove)
+    and a sorted copy for median/MAD, plus the EWMA over all values
+    """
+    window: int = 20
+    values: deque = field(default_factory=deque)
+    ordered: List[float] = field(default_factory=list)
+    mean: float = 0.0
+    m2: float = 0.0
+    ewma: float = math.nan
+    n_total: int = 0
+
+    @property
+    def n(self) -> int:
+        return len(self.values)
+
+    @property
+    def sd(self) -> float:
+        return math.sqrt(max(self.m2, 0.0) / (self.n - 1)) if self.n > 1 else math.nan
+
+    @property
+    def median(self) -> float:
+        return float(np.median(self.ordered)) if self.ordered else math.nan
+
+    @property
+    def mad(self) -> float:
+        return float(np.median(np.abs(np.asarray(self.ordered) - self.median))) if self.ordered else math.nan
+
+    def add(self, x: float, ewma_lambda: float):
+        if self.n == self.window:
+            y = self.values.popleft()
+            del self.ordered[bisect.bisect_left(self.ordered, y)]
+            d = y - self.mean
+            self.mean -= d / self.n
+            self.m2 -= d * (y - self.mean)
+        self.values.append(x)
+        bisect.insort(self.ordered, x)
+        d = x - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (x - self.mean)
+        self.ewma = x if self.n_total == 0 else ewma_lambda * x + (1 - ewma_lambda) * self.ewma
+        self.n_total += 1
+
+    def check(self, x: float, limit: float, ewma_lambda: float) -> List[str]:
+        """
+        the control rules violated by x, in relation to the current (i.e. previous runs') state
+        """
+        flags = list()
+        sd = self.sd
+        if sd > 0 and abs(x - self.mean) > limit * sd:
+            flags.append('shewhart')
+        mad = self.mad
+        if mad > 0 and abs(x - self.median) > limit * MAD_SCALE * mad:
+            flags.append('robust')
+        if sd > 0:
+            ewma = ewma_lambda * x + (1 - ewma_lambda) * self.ewma
+            if abs(ewma - self.mean) > limit * sd * math.sqrt(ewma_lambda / (2 - ewma_lambda)):
+                flags.append('ewma')
+        return flags
+
+    def to_dict(self) -> Dict:
+        return {'values': list(self.values), 'mean': self.mean, 'm2': self.m2, 'ewma': self.ewma, 'n_total': self.n_total}
+
+    @classmethod
+    def from_dict(cls, d: Dict, window: int) -> 'MetricState':
+        return cls(window=window, values=deque(d['values']), ordered=sorted(d['values']),
+                   mean=d['mean'], m2=d['m2'], ewma=d['ewma'], n_total=d['n_total'])
+
+
+@dataclass
+class Flag:
+    run: str
+    time: str
+    metric: str
+    value: float
+    rules: List[str]
+
+
+class ControlChart:
+    """
+    ControlChart keeps a MetricState per metric column (see study_matrix.metric_columns) of a QC series,
+    i.e. per accession, name, and description, so e.g. the ID metrics at different FDR thresholds are separate series
+    """
+    def __init__(self, window: int = 20, ewma_lambda: float = 0.2, limit: float = 3.0,
+                 min_history: int = 5, exclude_flagged: bool = True):
+        self.window = window
+        self.ewma_lambda = ewma_lambda
+        self.limit = limit
+        self.min_history = min_history
+        self.exclude_flagged = exclude_flagged
+        self.states: Dict[str, MetricState] = dict()
+        self.last_time: datetime = None
+        self.runs: List[str] = list()
+        self._seen: Set[str] = set()
+
+    def add_run(self, run: qc.RunQuality) -> List[Flag]:
+        """
+        check the metrics of a run against the baseline, then add them to it (unless flagged and exclude_flagged)
+        """
+        name = base_run_name(run.metadata.inputFiles)
+        time = completion_time(run)
+        if time is None:
+            logging.warning("Run {} has no completion time, ignoring it.".format(name))
+            return []
+        if name in self._seen:
+            logging.info("Run {} is already in the series, skipping it.".format(name))
+            return []
+        if self.last_time is not None and time < self.last_time:
+            logging.warning("Run {} completed before the last run in the series, ignoring it.".format(name))
+            return []
+        flags = list()
+        for metric in run.qualityMetrics:
+            for col, x in metric_columns(metric):
+                if math.isnan(x):
+                    continue
+                state = self.states.setdefault(col, MetricState(window=self.window))
+                rules = state.check(x, self.limit, self.ewma_lambda) if state.n >= self.min_history else []
+                if rules:
+                    flags.append(Flag(name, time.isoformat(), col, x, rules))
+                if not (rules and self.exclude_flagged):
+                    state.add(x, self.ewma_lambda)
+        self.last_time = time
+        self.runs.append(name)
+        self._seen.add(name)
+        return flags
+
+    def add_mzqcs(self, mzqcs: List[qc.MzQcFile]) -> List[Flag]:
+        """
+        add the runs of the given mzQC in order of completion time, runs without completion time are skipped
+        """
+        timed = list()
+        for rq in (rq for m in mzqcs for rq in m.runQualities):
+            time = completion_time(rq)
+            if time is None:
+                logging.warning("Run {} has no completion time, ignoring it.".format(base_run_name(rq.metadata.inputFiles)))
+            else:
+                timed.append((time, rq))
+        timed.sort(key=lambda t: t[0])
+        return [f for _, rq in timed for f in self.add_run(rq)]
+
+    def add_files(self, paths: List[str]) -> List[Flag]:
+        mzqcs = list()
+        for p in paths:
+            with open(p, "r") as f:
+                mzqcs.append(qc.JsonSerialisable.FromJson(f))
+        return self.add_mzqcs(mzqcs)
+
+    def limits(self) -> Dict[str, Dict[str, float]]:
+        """
+        current centre lines and control limits of all metrics
+        """
+        res = dict()
+        for col, s in self.states.items():
+            res[col] = {'mean': s.mean, 'sd': s.sd, 'lower': s.mean - self.limit * s.sd, 'upper': s.mean + self.limit * s.sd,
+                        'median': s.median, 'mad': s.mad, 'ewma': s.ewma, 'n': s.n_total}
+        return res
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({'window': self.window, 'ewma_lambda': self.ewma_lambda, 'limit': self.limit,
+                       'min_history': self.min_history, 'exclude_flagged': self.exclude_flagged,
+                       'last_time': self.last_time.isoformat() if self.last_time else None, 'runs': self.runs,
+                       'states': {col: s.to_dict() for col, s in self.states.items()}}, f, indent=1)
+
+    @classmethod
+    def load(cls, path: str, window: int = None, ewma_lambda: float = None, limit: float = None,
+             min_history: int = None) -> 'ControlChart':
+        """
+        load a saved state, the given window and ewma_lambda must match the state's,
+        a given limit or min_history replaces the saved one (the state does not depend on them)
+        """
+        with open(path, 'r') as f:
+            d = json.load(f)
+        for param, value in (('window', window), ('ewma_lambda', ewma_lambda)):
+            if value is not None and value != d[param]:
+                raise ValueError("The state {} was built with {} {}, not {}.".format(path, param, d[param], value))
+        for param, value in (('limit', limit), ('min_history', min_history)):
+            if value is not None and value != d[param]:
+                logging.warning("Using {} {} instead of {} of the state {}.".format(param, value, d[param], path))
+                d[param] = value
+        cc = cls(d['window'], d['ewma_lambda'], d['limit'], d['min_history'], d['exclude_flagged'])
+        cc.last_time = datetime.fromisoformat(d['last_time']) if d['last_time'] else None
+        cc.runs = d['runs']
+        cc._seen = set(cc.runs)
+        cc.states = {col: MetricState.from_dict(s, cc.window) for col, s in d['states'].items()}
+        return cc
+
+
+def completion_time(run: qc.RunQuality) -> Optional[datetime]:
+    """
+    the `completion time` file property of the run's first input file (naive UTC), None if there is none,
+    pymzqc-usecase's construct_mzqc puts the time in the description, other writers in the value
+    """
+    for prop in next(iter(run.metadata.inputFiles)).fileProperties or []:
+        if prop.accession == COMPLETION_TIME:
+            value = prop.value if prop.value is not None else prop.description
+            if not isinstance(value, datetime):
+                value = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+            # aware times are compared in UTC, naive ones are taken as is
+            return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+    return None
+
+
+@click.command(short_help='Update a longitudinal control chart state with new mzQC files and report out-of-control metrics.')
+@click.argument('state', type=click.Path(dir_okay=False))  # help="The control chart state file (JSON), created if missing"
+@click.argument('mzqc_input', nargs=-1, type=click.Path(exists=True, readable=True, dir_okay=False))  # help="The new mzqc files"
+@click.option('--window', type=click.IntRange(min=2), help="Number of previous runs in the rolling baseline. [default: 20, must match an existing state]")
+@click.option('--ewma_lambda', type=click.FloatRange(0, 1, min_open=True), help="EWMA weight of the newest run. [default: 0.2, must match an existing state]")
+@click.option('--limit', type=float, help="Control limit in (robust) standard deviations. [default: 3.0, or that of an existing state]")
+@click.option('--min_history', type=click.IntRange(min=2), help="Number of runs in the baseline before runs are checked. [default: 5, or that of an existing state]")
+@click.option('--log', type=click.Choice(['debug', 'info', 'warn'], case_sensitive=False),
+    default='warn', show_default=True,
+    required=False, help="Log detail level. (verbosity: debug>info>warn)")
+def update_control_chart(state, mzqc_input, window, ewma_lambda, limit, min_history, log):
+    lev = {'debug': logging.DEBUG,
+        'info': logging.INFO,
+        'warn': logging.WARN }
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=lev[log])
+
+    params = dict(window=window, ewma_lambda=ewma_lambda, limit=limit, min_history=min_history)
+    try:
+        cc = ControlChart.load(state, **params)
+    except FileNotFoundError:
+        cc = ControlChart(**{k: v for k, v in params.items() if v is not None})
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    flags = cc.add_files(list(mzqc_input))
+    cc.save(state)
+    for f in flags:
+        click.echo("{}\t{}\t{}\t{:g}\t{}".format(f.time, f.run, f.metric, f.value, ','.join(f.rules)))
+
+if __name__ == '__main__':
+    update_control_chart()
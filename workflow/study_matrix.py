@@ -0,0 +1,264 @@
+"""
+Study-level run x metric matrix from many mzQC files, for the heatmap/PCA analyses of mzqclibs-notebook.ipynb.
+All single value (and short list) metrics of all runs are collected as flat (run, metric, value) arrays
+and scattered into one dense NumPy matrix at once, the matrix can be cached to disk and grown with new runs.
+IncrementalPCA and RunningScaler work batch-wise, so thousands of runs need not be decomposed in one go.
+"""
+import os
+from numbers import Number
+from typing import Dict, List, Tuple, Callable
+import numpy as np
+from mzqc import MZQCFile as qc
+
+MAX_VECTOR_LEN = 8  # list values up to this length are split into one column per element (e.g. ranges, quarters)
+# table metrics reduced to a single column (as in the notebook's `ticintensities_sum`)
+TABLE_REDUCTIONS: Dict[Tuple[str, str], Callable] = {
+    ('MS:4000104', 'MS:1000285'): np.nansum,  # TIC, sum of intensities
+}
+
+
+def base_run_name(ifs: List[qc.InputFile]) -> str:
+    fn = next(iter(ifs)).name
+    if fn.endswith(('.mzML', '.mzml', '.mzid', '.mgf')):
+        return next(iter(os.path.splitext(os.path.basename(fn))))
+    else:
+        return fn
+
+def metric_columns(metric: qc.QualityMetric) -> List[Tuple[str, float]]:
+    """
+    metric_columns turns a quality metric into (column name, value) pairs,
+    placeholder accessions (e.g. 'MS:4000xxx') are disambiguated by the metric name,
+    and metrics with a description (e.g. the same ID metric 'at 1% FDR' and 'at 5% FDR') by the description
+    """
+    col = metric.accession if 'x' not in metric.accession else "{} {}".format(metric.accession, metric.name)
+    if metric.description:
+        col = "{} ({})".format(col, metric.description)
+    value = metric.value
+    if isinstance(value, bool):
+        return []
+    if isinstance(value, Number):
+        return [(col, float(value))]
+    if isinstance(value, list) and 0 < len(value) <= MAX_VECTOR_LEN and all(isinstance(v, Number) for v in value):
+        return [("{}[{}]".format(col, i), float(v)) for i, v in enumerate(value)]
+    if isinstance(value, dict):
+        return [("{} {}".format(col, sub), float(reduce(np.asarray(value[sub], dtype=float))))
+                for (acc, sub), reduce in TABLE_REDUCTIONS.items() if acc == metric.accession and sub in value]
+    return []
+
+
+class StudyMatrix:
+    """
+    StudyMatrix holds a dense float64 run x metric matrix (missing values are NaN),
+    with the run and metric labels and the mzQC files it was built from.
+    Storage grows by doubling, so appending runs (or new metrics) does not copy the matrix each time.
+    """
+    def __init__(self):
+        self.runs: List[str] = list()
+        self.metrics: List[str] = list()
+        self.sources: Dict[str, int] = dict()  # mzQC path -> modification time (ns) when read
+        self.source_runs: Dict[str, List[str]] = dict()  # mzQC path -> names of its runs
+        self._run_idx: Dict[str, int] = dict()
+        self._metric_idx: Dict[str, int] = dict()
+        self._values = np.full((0, 0), np.nan)
+
+    @property
+    def values(self) -> np.ndarray:
+        """
+        view (no copy) of the filled part of the matrix
+        """
+        return self._values[:len(self.runs), :len(self.metrics)]
+
+    def to_frame(self):
+        import pandas as pd
+        return pd.DataFrame(self.values, index=pd.Index(self.runs, name='run_name'), columns=self.metrics)
+
+    def _index(self, labels: List[str], lookup: Dict[str, int], key: str) -> int:
+        if key not in lookup:
+            lookup[key] = len(labels)
+            labels.append(key)
+        return lookup[key]
+
+    def _reserve(self, n_runs: int, n_metrics: int):
+        rows, cols = self._values.shape
+        if n_runs <= rows and n_metrics <= cols:
+            return
+        grown = np.full((max(n_runs, 2 * rows), max(n_metrics, 2 * cols)), np.nan)
+        grown[:rows, :cols] = self._values
+        self._values = grown
+
+    def add_mzqc(self, mzqc: qc.MzQcFile):
+        """
+        add all run qualities of an (in-memory) mzQC, runs of the same name are joined into one row
+        """
+        self.add_mzqcs([mzqc])
+
+    def add_mzqcs(self, mzqcs: List[qc.MzQcFile]):
+        rows, cols, vals = list(), list(), list()
+        for mzqc in mzqcs:
+            for run in mzqc.runQualities:
+                r = self._index(self.runs, self._run_idx, base_run_name(run.metadata.inputFiles))
+                for metric in run.qualityMetrics:
+                    for col, val in metric_columns(metric):
+                        rows.append(r)
+                        cols.append(self._index(self.metrics, self._metric_idx, col))
+                        vals.append(val)
+        self._reserve(len(self.runs), len(self.metrics))
+        if rows:
+            self._values[np.asarray(rows), np.asarray(cols)] = np.asarray(vals, dtype=float)
+
+    def add_files(self, paths: List[str]) -> int:
+        """
+        read and add mzQC files not (or not in this version) added before, returns the number of files read
+        """
+        new = {os.path.abspath(p) for p in paths if self.sources.get(os.path.abspath(p)) != os.stat(p).st_mtime_ns}
+        # a modified mzQC may lack metrics of its previous version, so the rows of its runs are cleared
+        # and refilled from all files contributing to them
+        stale = {r for p in new for r in self.source_runs.get(p, [])}
+        if stale:
+            self._values[[self._run_idx[r] for r in stale], :] = np.nan
+            new |= {p for p, runs in self.source_runs.items() if stale.intersection(runs) and os.path.exists(p)}
+        mzqcs = list()
+        for p in sorted(new):
+            with open(p, "r") as f:
+                mzqcs.append(qc.JsonSerialisable.FromJson(f))
+            self.sources[p] = os.stat(p).st_mtime_ns
+            self.source_runs[p] = [base_run_name(run.metadata.inputFiles) for run in mzqcs[-1].runQualities]
+        self.add_mzqcs(mzqcs)
+        return len(new)
+
+    def save(self, path: str):
+        """
+        cache the matrix as .npz
+        """
+        np.savez(path, values=self.values, runs=np.array(self.runs, dtype=str), metrics=np.array(self.metrics, dtype=str),
+                 source_paths=np.array(list(self.sources.keys()), dtype=str),
+                 source_mtimes=np.array(list(self.sources.values()), dtype=np.int64),
+                 source_run_paths=np.array([p for p, runs in self.source_runs.items() for _ in runs], dtype=str),
+                 source_run_names=np.array([r for runs in self.source_runs.values() for r in runs], dtype=str))
+
+    @classmethod
+    def load(cls, path: str) -> 'StudyMatrix':
+        sm = cls()
+        with np.load(path) as npz:
+            sm.runs = npz['runs'].tolist()
+            sm.metrics = npz['metrics'].tolist()
+            sm._values = npz['values'].copy()
+            sm.sources = dict(zip(npz['source_paths'].tolist(), npz['source_mtimes'].tolist()))
+            if 'source_run_paths' in npz.files:
+                for p, r in zip(npz['source_run_paths'].tolist(), npz['source_run_names'].tolist()):
+                    sm.source_runs.setdefault(p, list()).append(r)
+        sm._run_idx = {r: i for i, r in enumerate(sm.runs)}
+        sm._metric_idx = {m: i for i, m in enumerate(sm.metrics)}
+        return sm
+
+    @classmethod
+    def from_files(cls, paths: List[str], cache: str = None) -> 'StudyMatrix':
+        """
+        build from mzQC files, with a cache file only the files not already in the cache are read
+        """
+        sm = cls.load(cache) if cache and os.path.exists(cache) else cls()
+        if sm.add_files(paths) and cache:
+            sm.save(cache)
+        return sm
+
+    def zscores(self) -> np.ndarray:
+        """
+        column-wise z-scores, missing values and constant columns are set to 0
+        """
+        return RunningScaler().partial_fit(self.values).transform(self.values)
+
+
+class RunningScaler:
+    """
+    z-score scaling with column means and variances updated batch-wise (Chan et al.), ignoring NaN
+    """
+    def __init__(self):
+        self.n = None
+        self.mean = None
+        self.m2 = None
+
+    def partial_fit(self, x: np.ndarray) -> 'RunningScaler':
+        x = np.atleast_2d(x)
+        valid = ~np.isnan(x)
+        n_b = valid.sum(axis=0)
+        mean_b = np.divide(np.nansum(x, axis=0), n_b, out=np.zeros(x.shape[1]), where=n_b > 0)
+        m2_b = np.nansum(np.where(valid, x - mean_b, 0) ** 2, axis=0)
+        if self.n is None:
+            self.n, self.mean, self.m2 = n_b, mean_b, m2_b
+            return self
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        safe_n = np.maximum(n, 1)
+        self.mean = self.mean + delta * n_b / safe_n
+        self.m2 = self.m2 + m2_b + delta ** 2 * self.n * n_b / safe_n
+        self.n = n
+        return self
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(np.divide(self.m2, self.n - 1, out=np.zeros_like(self.m2), where=self.n > 1))
+
+    def transform(self, x: np.ndarray) -> np.ndarray:
+        std = self.std
+        z = np.divide(x - self.mean, std, out=np.zeros(np.shape(x)), where=std > 0)
+        return np.nan_to_num(z, nan=0.0)
+
+
+class IncrementalPCA:
+    """
+    PCA updated batch-wise from the previous components and singular values (Ross et al. 2008),
+    memory is bounded by the batch size and the number of metrics
+    """
+    def __init__(self, n_components: int = 2):
+        self.n_components = n_components
+        self.n_samples = 0
+        self.mean = None
+        self.components = None
+        self.singular_values = None
+        self.explained_variance = None
+
+    def partial_fit(self, x: np.ndarray) -> 'IncrementalPCA':
+        x = np.atleast_2d(np.asarray(x, dtype=float))
+        n_b = x.shape[0]
+        mean_b = x.mean(axis=0)
+        if self.n_samples == 0:
+            stacked = x - mean_b
+            mean = mean_b
+        else:
+            n = self.n_samples + n_b
+            mean = self.mean + (mean_b - self.mean) * n_b / n
+            correction = np.sqrt(self.n_samples * n_b / n) * (self.mean - mean_b)
+            stacked = np.vstack([self.singular_values[:, None] * self.components, x - mean_b, correction])
+        _, s, vt = np.linalg.svd(stacked, full_matrices=False)
+        # deterministic sign: largest absolute loading of each component positive
+        signs = np.sign(vt[np.arange(vt.shape[0]), np.argmax(np.abs(vt), axis=1)])
+        signs[signs == 0] = 1
+        vt *= signs[:, None]
+        k = min(self.n_components, vt.shape[0])
+        self.n_samples += n_b
+        self.mean = mean
+        self.components = vt[:k]
+        self.singular_values = s[:k]
+        self.explained_variance = s[:k] ** 2 / max(self.n_samples - 1, 1)
+        return self
+
+    def transform(self, x: np.ndarray) -> np.ndarray:
+        return (np.atleast_2d(x) - self.mean) @ self.components.T
+
+
+def study_pca(sm: StudyMatrix, n_components: int = 2, batch_size: int = 500) -> Tuple[np.ndarray, IncrementalPCA]:
+    """
+    z-score the study matrix and fit an IncrementalPCA in batches of runs,
+    returns the run scores (runs x components) and the fitted PCA
+    """
+    values = sm.values
+    scaler = RunningScaler()
+    for i in range(0, values.shape[0], batch_size):
+        scaler.partial_fit(values[i:i + batch_size])
+    pca = IncrementalPCA(n_components)
+    for i in range(0, values.shape[0], batch_size):
+        # a first batch of fewer runs than n_components is decomposed into as many components as it has runs
+        pca.partial_fit(scaler.transform(values[i:i + batch_size]))
+    scores = np.vstack([pca.transform(scaler.transform(values[i:i + batch_size]))
+                        for i in range(0, values.shape[0], batch_size)]) if values.shape[0] else np.empty((0, n_components))
+    return scores, pca
@@ -0,0 +1,17 @@
+"""
+regression tests for the control charts of longitudinal, run with `python -m pytest workflow`
+"""
+from longitudinal import ControlChart
+from test_study_matrix import ID_COUNT, run_mzqc
+
+NOISE = [0, 3, -2, 1, -3, 2, -1, 0]
+
+
+def test_shift_at_one_fdr_threshold_is_flagged():
+    cc = ControlChart(window=20, limit=3.0, min_history=5)
+    baseline = [run_mzqc("run{}".format(i), i, {1: 5000 + d, 5: 9000 + d}) for i, d in enumerate(NOISE)]
+    assert cc.add_mzqcs(baseline) == []
+    flags = cc.add_mzqcs([run_mzqc("shifted", len(NOISE), {1: 4000, 5: 9001})])
+    flagged = {f.metric for f in flags}
+    assert flagged == {"{} (at 1% FDR)".format(ID_COUNT[0])}
+    assert 'shewhart' in flags[0].rules
@@ -0,0 +1,53 @@
+"""
+regression tests for the metric columns of study_matrix (also used by longitudinal), run with `python -m pytest workflow`
+"""
+from datetime import datetime, timedelta
+from typing import Dict
+import numpy as np
+from mzqc import MZQCFile as qc
+from study_matrix import StudyMatrix, metric_columns
+from longitudinal import ControlChart
+
+ID_COUNT = ("MS:1003251", "count of identified spectra")
+START = datetime(2024, 1, 1, 8, 0, 0)
+
+
+def run_mzqc(name: str, hours: int, id_counts: Dict[float, int]) -> qc.MzQcFile:
+    """
+    an mzQC of one run with the identified spectra count at several FDR thresholds, as pymzqc-usecase writes with repeated --fdr
+    """
+    infi = qc.InputFile(name=name + ".mzML", location=name + ".mzML", fileFormat=qc.CvParameter(accession="MS:1000584", name="mzML format"),
+                        fileProperties=[qc.CvParameter(accession="MS:1000747", name="completion time",
+                                                       value=(START + timedelta(hours=hours)).isoformat())])
+    anso = qc.AnalysisSoftware(accession="MS:1000000", name="test", version="0", uri="https://example.org")
+    metrics = [qc.QualityMetric(accession=ID_COUNT[0], name=ID_COUNT[1], description="at {:g}% FDR".format(fdr), value=count)
+               for fdr, count in id_counts.items()]
+    metrics.append(qc.QualityMetric(accession="MS:4000059", name="number of MS1 spectra", value=1000 + hours))
+    rq = qc.RunQuality(metadata=qc.MetaDataParameters(inputFiles=[infi], analysisSoftware=[anso]), qualityMetrics=metrics)
+    return qc.MzQcFile(version="1.0.0", runQualities=[rq])
+
+def multi_fdr_series(n: int = 4):
+    return [run_mzqc("run{}".format(i), i, {0.1: 1000 + i, 1: 5000 + i, 5: 9000 + i}) for i in range(n)]
+
+
+def test_metric_columns_keep_descriptions_apart():
+    cols = [c for m in multi_fdr_series(1)[0].runQualities[0].qualityMetrics for c, _ in metric_columns(m)]
+    assert len(cols) == len(set(cols)) == 4
+    assert "MS:4000059" in cols
+
+def test_study_matrix_column_per_fdr():
+    sm = StudyMatrix()
+    sm.add_mzqcs(multi_fdr_series())
+    frame = sm.to_frame()
+    assert frame.shape == (4, 4)
+    for fdr, base in [(0.1, 1000), (1, 5000), (5, 9000)]:
+        col = "{} (at {:g}% FDR)".format(ID_COUNT[0], fdr)
+        assert np.array_equal(frame[col].to_numpy(), base + np.arange(4))
+
+def test_control_chart_state_per_fdr():
+    cc = ControlChart(window=20, min_history=2)
+    cc.add_mzqcs(multi_fdr_series())
+    id_states = {col: s for col, s in cc.states.items() if col.startswith(ID_COUNT[0])}
+    assert len(id_states) == 3
+    assert all(s.n == 4 for s in id_states.values())
+    assert id_states["{} (at 1% FDR)".format(ID_COUNT[0])].mean == 5001.5
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+A parallel, cached runner for the steps of workflow.sh.
+Each raw file is converted, searched, and QC'ed in its own chain of steps, all chains (and the independent
+QC steps within each chain) run concurrently within a core budget. Step results are recorded under
+a hash of the step's input file contents, command, and tool version, so unchanged steps are skipped on re-run.
+"""
+import os
+import glob
+import json
+import hashlib
+import logging
+import shutil
+import subprocess
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict
+import click
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+CACHE_DIR = '.workflow-cache'
+
+
+@dataclass
+class Step:
+    name: str
+    command: List[str]
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+    image: str = ""  # container image the command is run in
+    depends_on: List[str] = field(default_factory=list)  # names of the steps that need to finish first
+    cores: int = 1
+
+
+class LocalExecutor:
+    """
+    runs the step commands directly, e.g. with local installs or stand-ins of the container tools on the PATH
+    """
+    def command(self, step: Step) -> List[str]:
+        return step.command
+
+    def tool_version(self, step: Step) -> str:
+        tool = shutil.which(step.command[0]) or step.command[0]
+        return version_stamp(tool)
+
+    def run(self, step: Step, workdir: str):
+        logging.info("Running {}: {}".format(step.name, ' '.join(self.command(step))))
+        subprocess.run(self.command(step), cwd=workdir, check=True)
+
+
+class SingularityExecutor(LocalExecutor):
+    """
+    runs the step commands inside their container images, like workflow.sh
+    """
+    def command(self, step: Step) -> List[str]:
+        return ['singularity', 'exec', step.image, *step.command]
+
+    def tool_version(self, step: Step) -> str:
+        return version_stamp(step.image)
+
+
+EXECUTORS = {'singularity': SingularityExecutor, 'local': LocalExecutor}
+
+def version_stamp(path: str) -> str:
+    """
+    cheap version stamp of a tool or container image: its path, size, and modification time
+    """
+    try:
+        st = os.stat(path)
+        return "{}:{}:{}".format(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    except OSError:
+        return path
+
+def build_steps(raw_files: List[str], fasta: str, submission: str, images: Dict[str,str], search_cores: int = 1) -> List[Step]:
+    """
+    build the DAG of workflow.sh steps: one shared tide-index and per raw file
+    conversion -> tide-search, and rmzqc, jmzqc, pymzqc on the mzML; finally the merge of all mzQC
+    """
+    cti = fasta + '.cti'
+    steps = [Step(name='tide-index', image=images['pymzqc'], inputs=[fasta], outputs=[cti],
+                  command=['crux', 'tide-index', '--overwrite', 'T', '--peptide-list', 'T', '--enzyme', 'trypsin',
+                           '--missed-cleavages', '3', '--decoy-prefix', 'DECOY_', '--output-dir', cti, fasta, cti])]
+    mzqcs = list()
+    for raw in raw_files:
+        base = os.path.splitext(raw)[0]
+        mzml = base + '.mzML'
+        cts = mzml + '.cts'
+        steps.extend([
+            Step(name='trfp:'+base, image=images['trfp'], inputs=[raw], outputs=[mzml],
+                 command=['ThermoRawFileParser.sh', '-i='+raw, '-f=2', '-b='+mzml]),
+            Step(name='tide-search:'+base, image=images['pymzqc'], inputs=[mzml, cti], outputs=[cts],
+                 depends_on=['trfp:'+base, 'tide-index'], cores=search_cores,
+                 command=['crux', 'tide-search', '--overwrite', 'T', '--num-threads', str(search_cores),
+                          '--output-dir', cts, mzml, cti]),
+            Step(name='rmzqc:'+base, image=images['rmzqc'], inputs=[mzml], outputs=[base+'.rmzqc.mzqc'],
+                 depends_on=['trfp:'+base],
+                 command=['rmzqc-cli.sh', mzml, base+'.rmzqc.mzqc']),
+            Step(name='jmzqc:'+base, image=images['jmzqc'], inputs=[mzml], outputs=[base+'.jmzqc.mzqc'],
+                 depends_on=['trfp:'+base],
+                 command=['jmzqc-cli.sh', '-f', mzml, '-o', base+'.jmzqc.mzqc']),
+            Step(name='pymzqc:'+base, image=images['pymzqc'], inputs=[mzml, cti, cts], outputs=[base+'.pymzqc.mzqc'],
+                 depends_on=['trfp:'+base, 'tide-index', 'tide-search:'+base],
+                 command=['pymzqc-usecase.py', mzml, cti, cts, base+'.pymzqc.mzqc']),
+        ])
+        mzqcs.extend([base+'.rmzqc.mzqc', base+'.jmzqc.mzqc', base+'.pymzqc.mzqc'])
+    steps.append(Step(name='merge', image=images['pymzqc'], inputs=mzqcs, outputs=[submission+'.mzqc'],
+                      depends_on=[s.name for s in steps if s.outputs[0] in mzqcs],
+                      command=['pymzqc-merge.py', *mzqcs, submission+'.mzqc']))
+    return steps
+
+
+class StepCache:
+    """
+    content-addressed record of finished steps in <workdir>/.workflow-cache,
+    file digests are memoised by path, size, and modification time so unchanged (raw) files are not re-read
+    """
+    def __init__(self, workdir: str):
+        self.workdir = workdir
+        self.cache_dir = os.path.join(workdir, CACHE_DIR)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.digests_path = os.path.join(self.cache_dir, 'digests.json')
+        try:
+            with open(self.digests_path, 'r') as f:
+                self.digests = json.load(f)
+        except (OSError, ValueError):
+            self.digests = dict()
+
+    def file_digest(self, path: str) -> str:
+        full = os.path.join(self.workdir, path)
+        if os.path.isdir(full):
+            sha = hashlib.sha256()
+            for root, dirs, files in os.walk(full):
+                dirs.sort()
+                for fn in sorted(files):
+                    p = os.path.relpath(os.path.join(root, fn), self.workdir)
+                    sha.update(p.encode())
+                    sha.update(self.file_digest(p).encode())
+            return sha.hexdigest()
+        st = os.stat(full)
+        memo = "{}:{}:{}".format(path, st.st_size, st.st_mtime_ns)
+        if memo not in self.digests:
+            sha = hashlib.sha256()
+            b = bytearray(128 * 1024)
+            mv = memoryview(b)
+            with open(full, 'rb', buffering=0) as f:
+                for n in iter(lambda: f.readinto(mv), 0):
+                    sha.update(mv[:n])
+            self.digests[memo] = sha.hexdigest()
+        return self.digests[memo]
+
+    def step_key(self, step: Step, tool_version: str) -> str:
+        sha = hashlib.sha256()
+        sha.update(json.dumps([step.command, tool_version]).encode())
+        for i in step.inputs:
+            sha.update(self.file_digest(i).encode())
+        return sha.hexdigest()
+
+    def is_done(self, key: str, step: Step) -> bool:
+        return os.path.exists(os.path.join(self.cache_dir, key)) and \
+            all(os.path.exists(os.path.join(self.workdir, o)) for o in step.outputs)
+
+    def record(self, key: str, step: Step):
+        with open(os.path.join(self.cache_dir, key), 'w') as f:
+            json.dump({'step': step.name, 'command': step.command, 'outputs': step.outputs}, f)
+
+    def is_current(self, memo: str) -> bool:
+        """
+        whether a memoised digest still belongs to an existing file of the same size and modification time
+        """
+        path, size, mtime = memo.rsplit(':', 2)
+        try:
+            st = os.stat(os.path.join(self.workdir, path))
+        except OSError:
+            return False
+        return "{}:{}".format(st.st_size, st.st_mtime_ns) == "{}:{}".format(size, mtime)
+
+    def save(self):
+        """
+        save the memoised digests, without those of files since removed or modified
+        """
+        self.digests = {memo: d for memo, d in self.digests.items() if self.is_current(memo)}
+        with open(self.digests_path, 'w') as f:
+            json.dump(self.digests, f)
+
+
+def run_steps(steps: List[Step], executor, workdir: str, cores: int = 1, dry_run: bool = False) -> Dict[str,str]:
+    """
+    run_steps starts every step whose dependencies have finished as long as the sum of the running steps'
+    cores stays within the budget; cached steps are skipped. Returns the status of each step.
+    """
+    cache = StepCache(workdir)
+    by_name = {s.name: s for s in steps}
+    status = dict()
+    pending = list(steps)
+    running = dict()
+    used = 0
+
+    def finish(step, key):
+        cache.record(key, step)
+        status[step.name] = 'done'
+
+    with ThreadPoolExecutor(max_workers=max(1, cores)) as pool:
+        while pending or running:
+            for step in list(pending):
+                if any(status.get(d) == 'failed' for d in step.depends_on):
+                    status[step.name] = 'failed'
+                    pending.remove(step)
+                    logging.warning("Skipping {} as a dependency failed.".format(step.name))
+                    continue
+                if not all(status.get(d) in ('done', 'cached') for d in step.depends_on):
+                    continue
+                step_cores = min(step.cores, cores)
+                if running and used + step_cores > cores:
+                    continue
+                pending.remove(step)
+                try:
+                    key = cache.step_key(step, executor.tool_version(step))
+                except OSError:
+                    if not dry_run:
+                        raise
+                    key = None  # inputs of a dry run are not necessarily there yet
+                if key and cache.is_done(key, step):
+                    status[step.name] = 'cached'
+                    logging.info("Skipping {} (unchanged).".format(step.name))
+                    continue
+                if dry_run:
+                    status[step.name] = 'done'
+                    click.echo(' '.join(executor.command(step)))
+                    continue
+                running[pool.submit(executor.run, step, workdir)] = (step, key, step_cores)
+                used += step_cores
+            if not running:
+                if pending and not any(all(d in status for d in s.depends_on) for s in pending):
+                    raise ValueError("Unresolvable step dependencies: {}".format(
+                        ', '.join(d for s in pending for d in s.depends_on if d not in by_name)))
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                step, key, step_cores = running.pop(fut)
+                used -= step_cores
+                try:
+                    fut.result()
+                    finish(step, key)
+                except Exception as e:
+                    status[step.name] = 'failed'
+                    logging.error("Step {} failed: {}".format(step.name, e))
+    cache.save()
+    return status
+
+
+@click.command(short_help='Run the workflow.sh steps for all raw files in parallel, skipping unchanged steps.')
+@click.argument('workdir', type=click.Path(exists=True, file_okay=False))
+@click.option('--fasta', show_default=True, default="uniprot-ecoli_k12-10-2023.fasta", help="The search database (in workdir).")
+@click.option('--submission', show_default=True, default="PXD040621", help="Name for the merged mzQC file.")
+@click.option('--cores', type=click.IntRange(min=1), show_default=True, default=os.cpu_count() or 1, help="Number of cores available to concurrent steps.")
+@click.option('--search-cores', type=click.IntRange(min=1), show_default=True, default=1, help="Number of cores (threads) per tide-search.")
+@click.option('--executor', type=click.Choice(list(EXECUTORS), case_sensitive=False), default='singularity', show_default=True,
+    help="How step commands are run: inside the container images, or directly with the tools (or stand-ins) on the PATH.")
+@click.option('--trfp', 'trfpsimg', show_default=True, default="../biocontainers-thermorawfileparser-1.4.1.simg", help="ThermoRawFileParser container image.")
+@click.option('--rmzqc', 'rmzqcsimg', show_default=True, default="../rmzqc-usecase.simg", help="rmzqc container image.")
+@click.option('--jmzqc', 'jmzqcsimg', show_default=True, default="../jmzqc-usecase.simg", help="jmzqc container image.")
+@click.option('--pymzqc', 'pymzqcsimg', show_default=True, default="../pymzqc-usecase.simg", help="pymzqc (and crux) container image.")
+@click.option('--dry-run', is_flag=True, default=False, help="Only print the commands of the steps that would run.")
+@click.option('--log', type=click.Choice(['debug', 'info', 'warn'], case_sensitive=False),
+    default='warn', show_default=True,
+    required=False, help="Log detail level. (verbosity: debug>info>warn)")
+def run_workflow(workdir, fasta, submission, cores, search_cores, executor, trfpsimg, rmzqcsimg, jmzqcsimg, pymzqcsimg, dry_run, log):
+    """
+    run all workflow.sh steps for the raw files in workdir
+    """
+    lev = {'debug': logging.DEBUG,
+        'info': logging.INFO,
+        'warn': logging.WARN }
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=lev[log])
+
+    raw_files = sorted(os.path.basename(f) for f in glob.glob(os.path.join(workdir, '*.raw')))
+    # image paths are relative to the workdir, as in workflow.sh
+    images = {k: os.path.abspath(os.path.join(workdir, v)) for k, v in
+        {'trfp': trfpsimg, 'rmzqc': rmzqcsimg, 'jmzqc': jmzqcsimg, 'pymzqc': pymzqcsimg}.items()}
+    steps = build_steps(raw_files, fasta, submission, images, search_cores)
+    status = run_steps(steps, EXECUTORS[executor](), workdir, cores, dry_run)
+
+    failed = [n for n, s in status.items() if s == 'failed']
+    if failed:
+        raise click.ClickException("Failed steps: {}".format(', '.join(failed)))
+    click.echo("Data pre-analysis complete. Ready to start the data analysis notebook.")
+
+if __name__ == '__main__':
+    run_workflow()